@@ -0,0 +1,405 @@
+"""Offline benchmarks for the domain resource.
+
+Runs Create, Update and Delete invocations against DomainManagerBenchFake,
+a stand-in for Route 53 Domains that holds a configurable number of domains
+and historical operations, pages its listings like the real API, and can add
+per-call latency and throttling. For each invocation it records the wall time
+and the number of calls made per registrar method, so regressions such as
+extra list_domains calls or linear scans show up before they ship:
+
+    python bench_all.py --domains 5000 --operations 20000 --latency-ms 50
+"""
+
+import argparse
+import os
+import random
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from botocore.exceptions import ClientError
+
+if __name__ == '__main__':
+    # Benchmarks run locally: keep crhelper from building its polling clients.
+    os.environ.setdefault('AWS_SAM_LOCAL', 'true')
+
+import index
+from index import DomainManager
+
+
+def _contact():
+    return {
+        'firstName': "Joe",
+        'lastName': "Bob",
+        'type': "PERSON",
+        'phoneNumber': "+1.3035551212",
+        'email': "joe@bob.com",
+        'addressLine1': "PO Box 123",
+        'city': "Nowhere",
+        'state': "CA",
+        'countryCode': "US",
+        'zipCode': "91222"
+    }
+
+
+def _boto_contact(contact: dict) -> dict:
+    return {
+        'FirstName': contact['firstName'],
+        'LastName': contact['lastName'],
+        'ContactType': contact['type'],
+        'AddressLine1': contact['addressLine1'],
+        'City': contact['city'],
+        'State': contact['state'],
+        'CountryCode': contact['countryCode'],
+        'ZipCode': contact['zipCode'],
+        'PhoneNumber': contact['phoneNumber'],
+        'Email': contact['email']
+    }
+
+
+class DomainManagerBenchFake(DomainManager):
+    """A Route 53 Domains stand-in for benchmarks.
+
+    The account owns domains domain00000.com, domain00001.com, ... and has
+    a history of completed operations, plus an in-flight transfer of
+    pending.com. Listings are paged page_size at a time, list_domains
+    honours an Expiry SortCondition and list_operations applies its
+    Status/Type/SubmittedSince filters the way the service does. Every call
+    sleeps latency seconds and, with probability throttle_rate, fails with a
+    ThrottlingException instead."""
+
+    def __init__(self, domains: int = 1000, operations: int = 1000, page_size: int = 20,
+                 latency: float = 0.0, throttle_rate: float = 0.0, seed: int = 0):
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.throttles = 0
+        self._lock = threading.Lock()
+
+        now = datetime.now(timezone.utc)
+        self.domains = [
+            {
+                'DomainName': f"domain{i:05d}.com",
+                'AutoRenew': True,
+                'TransferLock': True,
+                'Expiry': now + timedelta(days=1 + i % 365)
+            }
+            for i in range(domains)
+        ]
+        self.domain_names = {domain['DomainName'] for domain in self.domains}
+        self.operations = [
+            {
+                'OperationId': f"op-{i:06d}",
+                'Status': 'SUCCESSFUL',
+                'Type': 'UPDATE_NAMESERVER',
+                'DomainName': self.domains[i % domains]['DomainName'] if domains else "gone.com",
+                'SubmittedDate': now - timedelta(hours=i)
+            }
+            for i in range(operations)
+        ]
+        self.operations.append({
+            'OperationId': "op-pending",
+            'Status': 'IN_PROGRESS',
+            'Type': 'TRANSFER_IN_DOMAIN',
+            'DomainName': "pending.com",
+            'SubmittedDate': now - timedelta(days=1)
+        })
+
+    def _call(self, method: str):
+        with self._lock:
+            self.calls[method] += 1
+            throttled = self.random.random() < self.throttle_rate
+            if throttled:
+                self.throttles += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if throttled:
+            raise ClientError(
+                {'Error': {'Code': 'ThrottlingException', 'Message': "Rate exceeded"}},
+                method
+            )
+
+    def _page(self, items: list, marker: Optional[str], max_items: Optional[int]) -> dict:
+        start = int(marker) if marker else 0
+        end = start + (max_items or self.page_size)
+        page = {'Items': items[start:end]}
+        if end < len(items):
+            page['NextPageMarker'] = str(end)
+        return page
+
+    def list_domains(self, **kwargs) -> dict:
+        self._call('list_domains')
+        domains = self.domains
+        if kwargs.get('SortCondition', {}).get('Name') == 'Expiry':
+            domains = sorted(domains, key=lambda domain: domain['Expiry'],
+                             reverse=kwargs['SortCondition']['SortOrder'] == 'DESC')
+        page = self._page(domains, kwargs.get('Marker'), kwargs.get('MaxItems'))
+        page['Domains'] = page.pop('Items')
+        return page
+
+    def list_operations(self, **kwargs) -> dict:
+        self._call('list_operations')
+        operations = [
+            operation for operation in self.operations
+            if ('Status' not in kwargs or operation['Status'] in kwargs['Status']) and
+               ('Type' not in kwargs or operation['Type'] in kwargs['Type']) and
+               ('SubmittedSince' not in kwargs or operation['SubmittedDate'] >= kwargs['SubmittedSince'])
+        ]
+        page = self._page(operations, kwargs.get('Marker'), kwargs.get('MaxItems'))
+        page['Operations'] = page.pop('Items')
+        return page
+
+    def get_domain_detail(self, domain_name) -> dict:
+        self._call('get_domain_detail')
+        if domain_name not in self.domain_names:
+            raise index.DomainNotFound(domain_name)
+        boto_contact = _boto_contact(_contact())
+        return {
+            'DomainName': domain_name,
+            'AdminContact': boto_contact,
+            'RegistrantContact': boto_contact,
+            'TechContact': boto_contact,
+            'AutoRenew': True,
+            'Nameservers': [{'Name': "ns1.example.com"}]
+        }
+
+    def get_operation_detail(self, operation_id) -> dict:
+        self._call('get_operation_detail')
+        return {'OperationId': operation_id, 'Status': 'SUCCESSFUL'}
+
+    def check_domain_availability(self, domain_name) -> dict:
+        self._call('check_domain_availability')
+        return {'Availability': 'UNAVAILABLE' if domain_name in self.domain_names else 'AVAILABLE'}
+
+    def register_domain(self, **kwargs) -> dict:
+        self._call('register_domain')
+        return {'OperationId': "op-register"}
+
+    def update_domain_nameservers(self, *args, **kwargs) -> dict:
+        self._call('update_domain_nameservers')
+        return {'OperationId': "op-nameservers"}
+
+    def check_domain_transferability(self, **kwargs) -> dict:
+        self._call('check_domain_transferability')
+        return {'Transferability': {'Transferable': 'TRANSFERABLE'}}
+
+    def transfer_domain(self, **kwargs) -> dict:
+        self._call('transfer_domain')
+        return {'OperationId': "op-transfer"}
+
+    def list_prices(self, **kwargs) -> dict:
+        self._call('list_prices')
+        return {'Prices': [{
+            'Name': kwargs.get('Tld', 'com'),
+            'RegistrationPrice': {'Price': 14.0, 'Currency': 'USD'},
+            'TransferPrice': {'Price': 14.0, 'Currency': 'USD'},
+            'RenewalPrice': {'Price': 14.0, 'Currency': 'USD'}
+        }]}
+
+    def update_domain_contact(self, *args, **kwargs) -> dict:
+        self._call('update_domain_contact')
+        return {'OperationId': "op-contact"}
+
+    def enable_domain_auto_renew(self, *args, **kwargs) -> dict:
+        self._call('enable_domain_auto_renew')
+        return {}
+
+    def disable_domain_auto_renew(self, *args, **kwargs) -> dict:
+        self._call('disable_domain_auto_renew')
+        return {}
+
+
+class BenchRegistrarClient:
+    """Presents a DomainManagerBenchFake as a boto3 route53domains client,
+    so that benchmarks call it through DomainManagerLive, as the Lambda
+    does: its throttles are paced by the rate limiter and retried rather
+    than failing the invocation."""
+
+    def __init__(self, registrar: DomainManagerBenchFake):
+        self.registrar = registrar
+
+    def list_domains(self, **kwargs) -> dict:
+        return self.registrar.list_domains(**kwargs)
+
+    def list_operations(self, **kwargs) -> dict:
+        return self.registrar.list_operations(**kwargs)
+
+    def get_domain_detail(self, DomainName) -> dict:
+        try:
+            return self.registrar.get_domain_detail(DomainName)
+        except index.DomainNotFound:
+            raise ClientError(
+                {'Error': {'Code': 'InvalidInput', 'Message': f"Domain {DomainName} not found"}},
+                'GetDomainDetail'
+            )
+
+    def get_operation_detail(self, OperationId) -> dict:
+        return self.registrar.get_operation_detail(OperationId)
+
+    def check_domain_availability(self, DomainName) -> dict:
+        return self.registrar.check_domain_availability(DomainName)
+
+    def register_domain(self, **kwargs) -> dict:
+        return self.registrar.register_domain(**kwargs)
+
+    def update_domain_nameservers(self, DomainName, Nameservers) -> dict:
+        return self.registrar.update_domain_nameservers(DomainName, Nameservers)
+
+    def check_domain_transferability(self, **kwargs) -> dict:
+        return self.registrar.check_domain_transferability(**kwargs)
+
+    def transfer_domain(self, **kwargs) -> dict:
+        return self.registrar.transfer_domain(**kwargs)
+
+    def list_prices(self, **kwargs) -> dict:
+        return self.registrar.list_prices(**kwargs)
+
+    def update_domain_contact(self, DomainName, **contacts) -> dict:
+        return self.registrar.update_domain_contact(DomainName, contacts)
+
+    def enable_domain_auto_renew(self, DomainName) -> dict:
+        return self.registrar.enable_domain_auto_renew(DomainName)
+
+    def disable_domain_auto_renew(self, DomainName) -> dict:
+        return self.registrar.disable_domain_auto_renew(DomainName)
+
+
+def live_domain_manager(registrar: DomainManagerBenchFake) -> index.DomainManagerLive:
+    """A DomainManagerLive calling registrar, with a cache and rate limiter
+    of its own sized like a container's."""
+    domain_manager = index.DomainManagerLive(
+        cache=index.TtlCache(index.registrar_cache.ttl, index.registrar_cache.max_entries),
+        rate_limiter=index.TokenBucket(index.registrar_rate_limiter.max_rate, index.registrar_rate_limiter.burst)
+    )
+    domain_manager.client = BenchRegistrarClient(registrar)
+    return domain_manager
+
+
+@dataclass
+class Scenario:
+    name: str
+    request_type: str
+    properties: dict
+    old_properties: Optional[dict] = None
+
+
+@dataclass
+class BenchResult:
+    scenario: str
+    seconds: float
+    calls: Counter
+    throttles: int
+    error: Optional[str] = None
+    total_calls: int = field(init=False)
+
+    def __post_init__(self):
+        self.total_calls = sum(self.calls.values())
+
+
+def scenarios(domains: int) -> List[Scenario]:
+    """The invocations benchmarked: registering a new domain, re-creating
+    one whose transfer is in flight, updating the last domain in the
+    inventory (the worst case for a listing scan) with and without changes,
+    and deleting."""
+    last_domain = f"domain{max(domains - 1, 0):05d}.com"
+
+    def properties(domain_name, **extra):
+        return dict({'DomainName': domain_name, 'Contact': _contact(), 'AutoRenew': 'true'}, **extra)
+
+    return [
+        Scenario("create-register", 'Create', properties("brand-new.com")),
+        Scenario("create-pending-transfer", 'Create', properties("pending.com", TransferAuthCode="abc123")),
+        Scenario("update-no-change", 'Update', properties(last_domain, NameServers=["ns1.example.com"]),
+                 properties(last_domain, NameServers=["ns1.example.com"])),
+        Scenario("update-nameservers", 'Update', properties(last_domain, NameServers=["ns2.example.com"]),
+                 properties(last_domain, NameServers=["ns1.example.com"])),
+        Scenario("delete", 'Delete', properties(last_domain)),
+    ]
+
+
+def run_scenario(scenario: Scenario, domain_manager: DomainManager,
+                 registrar: Optional[DomainManagerBenchFake] = None) -> BenchResult:
+    """Runs scenario with domain_manager, counting the calls made to
+    registrar (by default domain_manager itself)."""
+    registrar = registrar or domain_manager
+    event = {
+        'RequestType': scenario.request_type,
+        'LogicalResourceId': "Domain",
+        'ResourceProperties': scenario.properties
+    }
+    if scenario.old_properties is not None:
+        event['OldResourceProperties'] = scenario.old_properties
+
+    index.domain_manager = domain_manager
+    index.helper.Data = {}
+    error = None
+
+    started = time.perf_counter()
+    try:
+        if scenario.request_type == 'Delete':
+            index.delete(event, None)
+        else:
+            index.create_or_update(event, None)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - started
+
+    return BenchResult(scenario.name, seconds, registrar.calls, registrar.throttles, error)
+
+
+def run(domains: int = 1000, operations: int = 1000, page_size: int = 20, latency: float = 0.0,
+        throttle_rate: float = 0.0, seed: int = 0, lookup_strategy: str = index.DOMAIN_LOOKUP_STRATEGY,
+        concurrent_lookup: bool = index.DOMAIN_LOOKUP_CONCURRENT) -> List[BenchResult]:
+    """Runs every scenario through a DomainManagerLive against a fresh fake,
+    so call counts don't leak between invocations. Throttled calls are
+    counted as calls, and retried as in the Lambda."""
+    results = []
+
+    for scenario in scenarios(domains):
+        registrar = DomainManagerBenchFake(domains, operations, page_size, latency, throttle_rate, seed)
+        domain_manager = live_domain_manager(registrar)
+        domain_manager.lookup_strategy = lookup_strategy
+        domain_manager.concurrent_lookup = concurrent_lookup
+        results.append(run_scenario(scenario, domain_manager, registrar))
+
+    return results
+
+
+def format_results(results: List[BenchResult]) -> str:
+    lines = [f"{'scenario':<26} {'wall ms':>9} {'calls':>6} {'throttled':>9}  calls by method"]
+    for result in results:
+        by_method = ", ".join(f"{method}={count}" for method, count in sorted(result.calls.items()))
+        lines.append(
+            f"{result.scenario:<26} {result.seconds * 1000:>9.1f} {result.total_calls:>6} {result.throttles:>9}  "
+            f"{by_method}" + (f"  [{result.error}]" if result.error else "")
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--domains', type=int, default=1000, help="domains in the account")
+    parser.add_argument('--operations', type=int, default=1000, help="historical operations in the account")
+    parser.add_argument('--page-size', type=int, default=20, help="items per listing page")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="latency added to every registrar call")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="fraction of calls that are throttled")
+    parser.add_argument('--lookup-strategy', choices=['probe', 'list'], default=index.DOMAIN_LOOKUP_STRATEGY)
+    parser.add_argument('--concurrent-lookup', action='store_true', default=index.DOMAIN_LOOKUP_CONCURRENT,
+                        help="look for the domain and its pending transfer at the same time")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    results = run(args.domains, args.operations, args.page_size, args.latency_ms / 1000.0,
+                  args.throttle_rate, args.seed, args.lookup_strategy, args.concurrent_lookup)
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
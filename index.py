@@ -1,16 +1,56 @@
 from __future__ import print_function
 
+import time
+
+_module_load_started = time.perf_counter()
+
 from abc import abstractmethod, ABC
-from dataclasses import dataclass
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timedelta, timezone
 
 from crhelper import CfnResource
+import json
 import logging
-import boto3
+import heapq
+import ipaddress
+import os
+import random
+import re
+import threading
 
-from typing import Optional, List
+from typing import Any, Callable, Hashable, Iterator, Optional, List, Tuple
 
 logger = logging.getLogger(__name__)
 
+class ColdStartTimer:
+    """Collects how long a cold start spends importing this module, building
+    the registrar client and making the first registrar call, and logs the
+    breakdown once, at the end of the container's first invocation."""
+
+    def __init__(self):
+        self.import_seconds: Optional[float] = None
+        self.client_seconds: Optional[float] = None
+        self.first_call_seconds: Optional[float] = None
+        self.reported = False
+
+    def report(self):
+        if self.reported:
+            return
+        self.reported = True
+
+        def ms(seconds):
+            return "not run" if seconds is None else f"{seconds * 1000:.1f}ms"
+
+        logger.info(
+            "Cold start: import %s, client build %s, first registrar call %s",
+            ms(self.import_seconds), ms(self.client_seconds), ms(self.first_call_seconds)
+        )
+
+
+cold_start = ColdStartTimer()
+
 helper = CfnResource(json_logging=False, log_level='DEBUG', boto_level='CRITICAL', sleep_on_delete=120, ssl_verify=None)
 
 
@@ -41,18 +81,123 @@ class Contact:
             'Email': self.email
         }
 
+@dataclass(frozen=True)
+class NameServer:
+    """A nameserver in canonical form: its name lowercased without a
+    trailing dot, and its glue IPs (only needed when the nameserver is
+    inside the domain it serves) normalized and sorted, so that the same
+    nameserver always compares equal however it was written."""
+    name: str
+    glue_ips: Tuple[str, ...] = ()
+
+    def __post_init__(self):
+        object.__setattr__(self, 'name', self.name.lower().rstrip('.'))
+        object.__setattr__(self, 'glue_ips', tuple(sorted(ipaddress.ip_address(ip).compressed for ip in self.glue_ips)))
+
+    @classmethod
+    def from_property(cls, value) -> 'NameServer':
+        """From a NameServers entry: a host name, or an object with a Name
+        and optionally GlueIps."""
+        if isinstance(value, dict):
+            return cls(str(value['Name']), tuple(value.get('GlueIps', ())))
+        return cls(str(value))
+
+    @classmethod
+    def from_boto(cls, value: dict) -> 'NameServer':
+        return cls(value['Name'], tuple(value.get('GlueIps', ())))
+
+    def to_boto(self):
+        if self.glue_ips:
+            return {'Name': self.name, 'GlueIps': list(self.glue_ips)}
+        return {'Name': self.name}
+
+
 @dataclass
 class DomainEvent:
     domain_name: str
     contact: Contact
     auto_renew: bool
-    name_servers: Optional[List[str]]
-    duration_in_years: int
+    name_servers: Optional[List[NameServer]]
+    # None means the TLD's minimum registration period.
+    duration_in_years: Optional[int]
+    transfer_auth_code: Optional[str] = None
+    # The role the domain is managed as, kept with its desired state so
+    # drift_handler checks it in the right account; None for the function's
+    # own account.
+    role_arn: Optional[str] = None
+
+
+PENDING_OPERATION_STATUSES = ['SUBMITTED', 'IN_PROGRESS']
+
+# Operations that bring a domain into the account. While one is in flight
+# the domain isn't in the account yet, but mustn't be registered or
+# transferred again.
+PENDING_OPERATION_TYPES = ['REGISTER_DOMAIN', 'TRANSFER_IN_DOMAIN']
+
+# Operations older than this are not considered in flight any more.
+PENDING_OPERATION_LOOKBACK_DAYS = int(os.environ.get('PENDING_OPERATION_LOOKBACK_DAYS', 30))
+
+
+# When set, Create and Update don't report back to CloudFormation until the
+# registrar operation they started has finished; crhelper re-invokes the
+# function every polling interval to check on it.
+POLL_MODE = os.environ.get('DOMAIN_POLL_MODE', 'false').lower() == 'true'
+
+# How long one poll invocation keeps checking an operation before handing
+# back to crhelper for the next polling interval.
+OPERATION_WAIT_SECONDS = float(os.environ.get('OPERATION_WAIT_SECONDS', 5))
+OPERATION_WAIT_INITIAL_DELAY_SECONDS = 0.5
+OPERATION_WAIT_MAX_DELAY_SECONDS = 4
+
+
+# How many of a domain's contact, auto-renew and nameserver updates are sent
+# to the registrar at once.
+DOMAIN_UPDATE_CONCURRENCY = int(os.environ.get('DOMAIN_UPDATE_CONCURRENCY', 3))
+
+
+# How many domains of a fleet resource are reconciled at once.
+DOMAIN_FLEET_CONCURRENCY = int(os.environ.get('DOMAIN_FLEET_CONCURRENCY', 8))
+
+
+# When set, every Update checks all of the domain's attributes against the
+# registrar, repairing drift, rather than only those whose properties changed.
+VERIFY_ON_UPDATE = os.environ.get('DOMAIN_VERIFY_ON_UPDATE', 'false').lower() == 'true'
+
+
+# How many domains drift_handler checks at once, and whether it corrects the
+# drift it finds by default.
+DRIFT_CONCURRENCY = int(os.environ.get('DRIFT_CONCURRENCY', 16))
+DRIFT_REPAIR = os.environ.get('DRIFT_REPAIR', 'false').lower() == 'true'
+
+
+def pending_operations_since() -> datetime:
+    # Rounded down to the day so the list_operations request stays the same
+    # (and cacheable) across invocations.
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=PENDING_OPERATION_LOOKBACK_DAYS)
+
+
+DOMAIN_LOOKUP_STRATEGY = os.environ.get('DOMAIN_LOOKUP_STRATEGY', 'probe')
+DOMAIN_LOOKUP_CONCURRENT = os.environ.get('DOMAIN_LOOKUP_CONCURRENT', 'false').lower() == 'true'
+
+
+class DomainNotFound(Exception):
+    """Raised by DomainManager.get_domain_detail for a domain that isn't in
+    the account."""
+    pass
 
 
 class DomainManager(ABC):
+    # Optional in-memory index of domain name -> list_domains summary, filled
+    # in as pages are streamed so repeat lookups don't go back to the
+    # registrar. Reset with reset_domain_index().
+    index_domains = True
+    _domain_index: Optional[dict] = None
+    _domain_index_marker: Optional[str] = None
+    _domain_index_complete = False
+
     @abstractmethod
-    def list_domains(self) -> dict:
+    def list_domains(self, **kwargs) -> dict:
         pass
 
     @abstractmethod
@@ -67,21 +212,210 @@ class DomainManager(ABC):
     def get_operation_detail(self, operation_id) -> dict:
         pass
 
+    # How get_domain_or_operation finds a domain: 'probe' asks for its detail
+    # directly, 'list' pages through list_domains.
+    lookup_strategy = DOMAIN_LOOKUP_STRATEGY
+
+    # Whether get_domain_or_operation looks for the domain and for an
+    # in-flight registration or transfer of it at the same time, rather than
+    # one after the other.
+    concurrent_lookup = DOMAIN_LOOKUP_CONCURRENT
+
+    # time.monotonic() value after which no new registrar call should start.
+    deadline: Optional[float] = None
+
+    def set_deadline(self, deadline: Optional[float]):
+        self.deadline = deadline
+
+    # Called with the method's name for every throttled attempt the manager
+    # absorbs by retrying, so a wrapper can count throttles that never reach
+    # it as errors.
+    on_throttle: Optional[Callable[[str], None]] = None
+
+    def reset_domain_index(self):
+        self._domain_index = None
+        self._domain_index_marker = None
+        self._domain_index_complete = False
+
+    def iter_domain_pages(self, marker: Optional[str] = None) -> Iterator[List[dict]]:
+        """Yields the pages of list_domains in order, starting at marker,
+        following NextPageMarker until the last page."""
+        while True:
+            if marker:
+                response = self.list_domains(Marker = marker)
+            else:
+                response = self.list_domains()
+
+            marker = response.get('NextPageMarker')
+            self._index_domain_page(response.get('Domains', []), marker)
+
+            yield response.get('Domains', [])
+
+            if not marker:
+                return
+
+    def iter_domains_by_expiry(self) -> Iterator[dict]:
+        """Yields the account's domain summaries soonest-expiring first,
+        fetching pages as they're consumed. These pages aren't indexed: their
+        markers only make sense in this order."""
+        marker = None
+        while True:
+            kwargs = {'SortCondition': {'Name': 'Expiry', 'SortOrder': 'ASC'}}
+            if marker:
+                kwargs['Marker'] = marker
+            response = self.list_domains(**kwargs)
+
+            yield from response.get('Domains', [])
+
+            marker = response.get('NextPageMarker')
+            if not marker:
+                return
+
+    def _index_domain_page(self, domains: List[dict], next_marker: Optional[str]):
+        if not self.index_domains:
+            return
+
+        if self._domain_index is None:
+            self._domain_index = {}
+
+        for domain in domains:
+            self._domain_index[domain['DomainName']] = domain
+
+        self._domain_index_marker = next_marker
+        self._domain_index_complete = not next_marker
+
+    def find_domain_summary(self, domain_name, stop: Optional[threading.Event] = None) -> Optional[dict]:
+        """Returns the list_domains summary for domain_name, or None if it
+        isn't in the account. Pages are only fetched until the one holding
+        the match; with index_domains on, pages already seen are answered
+        from the index and a later lookup resumes where the last one stopped.
+        Setting stop abandons the search before the next page."""
+        marker = None
+
+        if self.index_domains and self._domain_index is not None:
+            summary = self._domain_index.get(domain_name)
+            if summary is not None or self._domain_index_complete:
+                return summary
+            marker = self._domain_index_marker
+
+        for domains in self.iter_domain_pages(marker):
+            for domain in domains:
+                if domain['DomainName'] == domain_name:
+                    return domain
+
+            if stop is not None and stop.is_set():
+                return None
+
+        return None
+
+    def probe_domain_detail(self, domain_name) -> Optional[dict]:
+        """Returns the detail of domain_name, or None if it isn't in the
+        account, in a single get_domain_detail call."""
+        try:
+            return self.get_domain_detail(domain_name)
+        except DomainNotFound:
+            return None
+
+    def find_owned_domain(self, domain_name, stop: Optional[threading.Event] = None) -> Optional[dict]:
+        """Returns the detail of domain_name if it's in the account. With the
+        'probe' lookup_strategy the domain is looked up directly; with
+        'list' the account's domains are paged through to find it."""
+        if self.lookup_strategy == 'list':
+            if self.find_domain_summary(domain_name, stop) is None:
+                return None
+            return self.get_domain_detail(domain_name)
+
+        return self.probe_domain_detail(domain_name)
+
     def get_domain_or_operation(self, domain_name) -> Optional[dict | str]:
-        domains_response = self.list_domains()
+        """Returns the detail of domain_name if it's in the account, else the
+        OperationId of an in-flight registration or transfer of it, else
+        None."""
+        if self.concurrent_lookup:
+            return self._get_domain_or_operation_concurrently(domain_name)
+
+        detail = self.find_owned_domain(domain_name)
+        if detail is not None:
+            return detail
+
+        return self.find_pending_operation(domain_name)
+
+    def _get_domain_or_operation_concurrently(self, domain_name) -> Optional[dict | str]:
+        """Looks for the domain in the account and for an in-flight operation
+        bringing it in at the same time, returning as soon as either finds it and
+        stopping the other before its next page."""
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=2)
+        error = None
+
+        try:
+            futures = [
+                executor.submit(self.find_owned_domain, domain_name, stop),
+                executor.submit(self.find_pending_operation, domain_name, stop)
+            ]
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+
+                if result is not None:
+                    return result
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        # Neither search found the domain; that's only conclusive if both
+        # of them finished.
+        if error is not None:
+            raise error
 
-        for domain in domains_response['Domains']:
-            if domain['DomainName'] == domain_name:
-                return self.get_domain_detail(domain_name)
+        return None
 
-        operations_response = self.list_operations()
+    def iter_operation_pages(self, **filters) -> Iterator[List[dict]]:
+        """Yields the pages of list_operations matching the service-side
+        filters (Status, Type, SubmittedSince, ...), following
+        NextPageMarker until the last page."""
+        marker = None
 
-        for operation in operations_response['Operations']:
-            if (operation['Status'] == 'IN_PROGRESS' and
-                operation['Type'] == 'TRANSFER_IN_DOMAIN' and
-                operation['DomainName'] == domain_name):
+        while True:
+            if marker:
+                response = self.list_operations(Marker = marker, **filters)
+            else:
+                response = self.list_operations(**filters)
+
+            yield response.get('Operations', [])
+
+            marker = response.get('NextPageMarker')
+            if not marker:
+                return
+
+    def iter_pending_operations(self) -> Iterator[dict]:
+        """Yields the in-flight registrations and transfers into the account.
+        The registrar filters on status, type and age, so only those are
+        paged through."""
+        for operations in self.iter_operation_pages(
+            Status = PENDING_OPERATION_STATUSES,
+            Type = PENDING_OPERATION_TYPES,
+            SubmittedSince = pending_operations_since()
+        ):
+            for operation in operations:
+                if (operation['Status'] in PENDING_OPERATION_STATUSES and
+                    operation['Type'] in PENDING_OPERATION_TYPES):
+                    yield operation
+
+    def find_pending_operation(self, domain_name, stop: Optional[threading.Event] = None) -> Optional[str]:
+        """Returns the OperationId of an in-flight registration or transfer
+        of domain_name into the account, or None. Setting stop abandons the
+        search before the next page."""
+        for operation in self.iter_pending_operations():
+            if operation['DomainName'] == domain_name:
                 return operation['OperationId']
 
+            if stop is not None and stop.is_set():
+                return None
+
         return None
 
     @abstractmethod
@@ -104,82 +438,988 @@ class DomainManager(ABC):
     def transfer_domain(self, **kwargs) -> dict:
         pass
 
+    @abstractmethod
+    def list_prices(self, **kwargs) -> dict:
+        pass
+
+class TtlCache:
+    """A small thread-safe LRU cache whose entries expire after ttl seconds.
+    A ttl of 0 disables caching."""
+
+    def __init__(self, ttl: float, max_entries: int, clock: Callable[[], float] = time.monotonic):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key: Hashable, load: Callable[[], Any]) -> Any:
+        if self.ttl <= 0:
+            return load()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > self.clock():
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        value = load()
+
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def invalidate(self, predicate: Callable[[Hashable], bool]):
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every DomainManagerLive in a warm container, so sibling resources
+# deployed in the same stack reuse each other's inventory reads.
+registrar_cache = TtlCache(
+    ttl=float(os.environ.get('DOMAIN_CACHE_TTL_SECONDS', 30)),
+    max_entries=int(os.environ.get('DOMAIN_CACHE_MAX_ENTRIES', 512))
+)
+
+
+@dataclass
+class TldRules:
+    min_years: int = 1
+    max_years: int = 10
+    transferable: bool = True
+    registration_price: Optional[float] = None
+    transfer_price: Optional[float] = None
+    currency: Optional[str] = None
+
+
+# Registration periods the registrar's price listing doesn't describe, for
+# TLDs that don't accept the usual 1 to 10 years.
+TLD_DURATION_RULES = {
+    'ai': (2, 10),
+}
+
+
+def tld_of(domain_name: str) -> str:
+    return domain_name.rstrip('.').rsplit('.', 1)[-1].lower()
+
+
+def tld_rules_from_price(tld: str, price: Optional[dict]) -> TldRules:
+    """Builds the rules for tld from its entry in list_prices (None if the
+    registrar didn't list it) and TLD_DURATION_RULES."""
+    min_years, max_years = TLD_DURATION_RULES.get(tld, (1, 10))
+    rules = TldRules(min_years=min_years, max_years=max_years)
+
+    if price:
+        registration_price = price.get('RegistrationPrice') or {}
+        transfer_price = price.get('TransferPrice')
+        rules.transferable = transfer_price is not None
+        rules.registration_price = registration_price.get('Price')
+        rules.transfer_price = (transfer_price or {}).get('Price')
+        rules.currency = registration_price.get('Currency')
+
+    return rules
+
+
+class TldMetadataCache:
+    """Keeps each TLD's list_prices entry for ttl seconds, in memory and,
+    with a path, in a JSON file that outlives the process. A TLD is only
+    fetched from the registrar when neither holds a fresh entry."""
+
+    def __init__(self, ttl: float, path: Optional[str] = None, clock: Callable[[], float] = time.time):
+        self.ttl = ttl
+        self.path = path
+        self.clock = clock
+        self._entries: dict = {}
+        self._lock = threading.Lock()
+
+    def _read_file(self) -> dict:
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def _write_file(self):
+        if not self.path:
+            return
+        try:
+            temporary_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(temporary_path, self.path)
+        except OSError as e:
+            logger.warning("Could not write the TLD cache to %s: %s", self.path, e)
+
+    def _fresh(self, entry: Optional[dict]) -> bool:
+        return entry is not None and entry['fetched_at'] + self.ttl > self.clock()
+
+    def rules(self, tld: str, fetch: Callable[[str], Optional[dict]]) -> TldRules:
+        """Returns the rules for tld, calling fetch(tld) for its price entry
+        only on a cache miss. If the fetch fails, the static rules are used
+        and nothing is cached."""
+        with self._lock:
+            entry = self._entries.get(tld)
+            if not self._fresh(entry):
+                entry = self._read_file().get(tld)
+                if self._fresh(entry):
+                    self._entries[tld] = entry
+
+        if not self._fresh(entry):
+            try:
+                entry = {'fetched_at': self.clock(), 'price': fetch(tld)}
+            except Exception as e:
+                logger.warning("Could not fetch the price listing for .%s: %s", tld, e)
+                return tld_rules_from_price(tld, None)
+
+            with self._lock:
+                self._entries[tld] = entry
+                self._write_file()
+
+        return tld_rules_from_price(tld, entry['price'])
+
+
+tld_cache = TldMetadataCache(
+    ttl=float(os.environ.get('TLD_CACHE_TTL_SECONDS', 24 * 60 * 60)),
+    path=os.environ.get('TLD_CACHE_PATH')
+)
+
+
+def fetch_tld_price(manager: 'DomainManager', tld: str) -> Optional[dict]:
+    for price in manager.list_prices(Tld = tld).get('Prices', []):
+        if price.get('Name', '').lower() == tld:
+            return price
+    return None
+
+
+def resolve_duration(manager: 'DomainManager', domain_event: 'DomainEvent', transfer: bool = False) -> int:
+    """Returns the number of years to register or transfer domain_event's
+    domain for: its DurationInYears, or the TLD's minimum if it has none.
+    Raises ValueError, before any availability or transferability check,
+    if the TLD doesn't allow the duration or can't be transferred."""
+    tld = tld_of(domain_event.domain_name)
+    rules = tld_cache.rules(tld, lambda tld: fetch_tld_price(manager, tld))
+
+    if transfer and not rules.transferable:
+        raise ValueError(f"Domain {domain_event.domain_name} can't be transferred: .{tld} domains don't support transfers")
+
+    if domain_event.duration_in_years is None:
+        return rules.min_years
+
+    if not rules.min_years <= domain_event.duration_in_years <= rules.max_years:
+        raise ValueError(
+            f"DurationInYears {domain_event.duration_in_years} is not allowed for .{tld} domains; "
+            f"it must be between {rules.min_years} and {rules.max_years}"
+        )
+
+    return domain_event.duration_in_years
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class TokenBucket:
+    """A thread-safe token bucket that adapts its rate to the registrar:
+    every throttled call halves the rate (down to min_rate) and every
+    successful one adds increase back (up to max_rate)."""
+
+    def __init__(self, max_rate: float, burst: float, min_rate: float = 0.2, increase: float = 0.1,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.tokens = burst
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        """Takes a token, waiting for one if needed. Returns False, without
+        taking one, if none would be available before deadline (a
+        time.monotonic() value)."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None and self.clock() + wait > deadline:
+                return False
+
+            self.sleep(wait)
+
+    def on_throttle(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def on_success(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+# Route 53 Domains allows each account only a few requests per second. All
+# DomainManagerLive calls in a container share this bucket.
+registrar_rate_limiter = TokenBucket(
+    max_rate=float(os.environ.get('REGISTRAR_MAX_TPS', 5)),
+    burst=float(os.environ.get('REGISTRAR_BURST', 5))
+)
+
+REGISTRAR_MAX_ATTEMPTS = int(os.environ.get('REGISTRAR_MAX_ATTEMPTS', 8))
+REGISTRAR_BACKOFF_BASE_SECONDS = 0.1
+REGISTRAR_BACKOFF_CAP_SECONDS = 5
+
+# Time kept back from the Lambda timeout for sending the response.
+DEADLINE_MARGIN_SECONDS = 2
+
+# Route 53 Domains is only served from us-east-1, whatever the function's
+# region. REGISTRAR_ENDPOINT_URL points the client somewhere else, such as a
+# local stub.
+REGISTRAR_REGION = 'us-east-1'
+REGISTRAR_ENDPOINT_URL = os.environ.get('REGISTRAR_ENDPOINT_URL')
+REGISTRAR_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('REGISTRAR_CONNECT_TIMEOUT_SECONDS', 1))
+REGISTRAR_READ_TIMEOUT_SECONDS = float(os.environ.get('REGISTRAR_READ_TIMEOUT_SECONDS', 3))
+# A registrar call isn't started unless it would time out before the
+# deadline; with less time left the work is handed to a follow-up poll (or
+# fails) instead.
+REGISTRAR_MIN_CALL_SECONDS = REGISTRAR_CONNECT_TIMEOUT_SECONDS + REGISTRAR_READ_TIMEOUT_SECONDS
+# Enough kept-alive connections for a fleet reconciling every domain's
+# changes at once.
+REGISTRAR_MAX_POOL_CONNECTIONS = max(10, DOMAIN_FLEET_CONCURRENCY * DOMAIN_UPDATE_CONCURRENCY, DRIFT_CONCURRENCY)
+
+
+# Credentials for a target role last this long; botocore assumes the role
+# again shortly before they expire.
+ROLE_SESSION_NAME = 'DomainResource'
+ROLE_SESSION_SECONDS = int(os.environ.get('DOMAIN_ROLE_SESSION_SECONDS', 3600))
+
+
 class DomainManagerLive(DomainManager):
 
-    def __init__(self):
-        self.client = boto3.client('route53domains')
+    def __init__(self, cache: TtlCache = registrar_cache, rate_limiter: 'TokenBucket' = None,
+                 role_arn: Optional[str] = None):
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._sts = None
+        self.cache = cache
+        self.rate_limiter = rate_limiter or registrar_rate_limiter
+        # The role to manage another account's domains as; None for the
+        # function's own credentials.
+        self.role_arn = role_arn
+
+    @property
+    def client(self):
+        # Built on first use rather than at import, so invocations that never
+        # reach the registrar (e.g. Delete) don't pay for it. The client is
+        # then reused by every later invocation in the container.
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._create_client()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    def _create_client(self):
+        started = time.perf_counter()
+        import boto3
+
+        from botocore.config import Config
+
+        session = self._assume_role_session() if self.role_arn else boto3
+
+        # _call does the retrying, of throttles and of transient failures
+        # alike, so it can pace retries with the rate limiter and stop at
+        # the deadline. The timeouts keep one slow call from using up the
+        # whole invocation.
+        client = session.client('route53domains', region_name=REGISTRAR_REGION, endpoint_url=REGISTRAR_ENDPOINT_URL, config=Config(
+            retries={'mode': 'standard', 'total_max_attempts': 1},
+            connect_timeout=REGISTRAR_CONNECT_TIMEOUT_SECONDS,
+            read_timeout=REGISTRAR_READ_TIMEOUT_SECONDS,
+            max_pool_connections=REGISTRAR_MAX_POOL_CONNECTIONS,
+            tcp_keepalive=True
+        ))
+
+        if cold_start.client_seconds is None:
+            cold_start.client_seconds = time.perf_counter() - started
+            self._time_first_call(client)
+
+        return client
+
+    def _assume_role_session(self):
+        """A boto3 session acting as role_arn. Its credentials are fetched
+        from STS on its first request, not here, and again before they
+        expire, for as long as the container lives."""
+        import boto3
+
+        from botocore.credentials import DeferredRefreshableCredentials
+        from botocore.session import get_session
+
+        botocore_session = get_session()
+        botocore_session._credentials = DeferredRefreshableCredentials(
+            refresh_using=self._assume_role, method='sts-assume-role'
+        )
+        return boto3.Session(botocore_session=botocore_session)
+
+    def _assume_role(self) -> dict:
+        import boto3
+
+        if self._sts is None:
+            self._sts = boto3.client('sts')
 
-    def list_domains(self) -> dict:
-        return self.client.list_domains()
+        credentials = self._sts.assume_role(
+            RoleArn=self.role_arn, RoleSessionName=ROLE_SESSION_NAME, DurationSeconds=ROLE_SESSION_SECONDS
+        )['Credentials']
+        logger.info("Assumed %s until %s", self.role_arn, credentials['Expiration'])
+
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat()
+        }
+
+    @staticmethod
+    def _time_first_call(client):
+        call_started = []
+
+        def before_call(**kwargs):
+            call_started.append(time.perf_counter())
+
+        def after_call(**kwargs):
+            if cold_start.first_call_seconds is None and call_started:
+                cold_start.first_call_seconds = time.perf_counter() - call_started[0]
+            client.meta.events.unregister('before-call.route53domains', before_call)
+            client.meta.events.unregister('after-call.route53domains', after_call)
+
+        client.meta.events.register('before-call.route53domains', before_call)
+        client.meta.events.register('after-call.route53domains', after_call)
+
+    def _call(self, method: str, **kwargs) -> dict:
+        """Makes a registrar call through the shared rate limiter, retrying
+        it with jittered exponential backoff for as long as the deadline
+        allows when it was throttled or failed transiently (see
+        is_retryable_error). Each attempt must start with at least
+        REGISTRAR_MIN_CALL_SECONDS of the deadline left, so waiting for a
+        token or backing off can't eat into the time the call itself needs,
+        and a call that hangs times out before the deadline."""
+        attempt = 0
+        start_by = self.deadline - REGISTRAR_MIN_CALL_SECONDS if self.deadline is not None else None
+
+        while True:
+            if not self.rate_limiter.acquire(start_by) or (start_by is not None and time.monotonic() > start_by):
+                raise DeadlineExceeded(f"No time left to call {method}")
+
+            try:
+                response = getattr(self.client, method)(**kwargs)
+            except Exception as e:
+                if not is_retryable_error(method, e):
+                    raise
+
+                throttled = is_throttling_error(e)
+                if throttled:
+                    self.rate_limiter.on_throttle()
+                attempt += 1
+                backoff = random.uniform(0, min(REGISTRAR_BACKOFF_CAP_SECONDS, REGISTRAR_BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+                if attempt >= REGISTRAR_MAX_ATTEMPTS:
+                    raise
+
+                # From here the throttle doesn't surface as such, whether
+                # the call is retried or runs out of time.
+                if throttled and self.on_throttle is not None:
+                    self.on_throttle(method)
+
+                if start_by is not None and time.monotonic() + backoff > start_by:
+                    raise DeadlineExceeded(f"No time left to retry {method}") from e
+
+                logger.info("%s %s, retrying in %.2fs (attempt %d)",
+                            method, "throttled" if throttled else f"failed ({e})", backoff, attempt)
+                time.sleep(backoff)
+                continue
+
+            self.rate_limiter.on_success()
+            return response
+
+    def _cached(self, method: str, load: Callable[[], dict], **kwargs) -> dict:
+        key = (method, json.dumps(kwargs, sort_keys=True, default=str))
+        return self.cache.get_or_load(key, load)
+
+    def _invalidate(self, domain_name: str, inventory: bool = False):
+        """Drops cached reads a mutation of domain_name makes stale: its
+        detail and the operation listing always, and the domain listing too
+        when the mutation changes what list_domains returns."""
+        detail_key = ('get_domain_detail', json.dumps({'DomainName': domain_name}))
+        stale_methods = {'list_operations', 'list_domains'} if inventory else {'list_operations'}
+
+        self.cache.invalidate(lambda key: key == detail_key or key[0] in stale_methods)
+
+        if inventory:
+            self.reset_domain_index()
+
+    def list_domains(self, **kwargs) -> dict:
+        return self._cached('list_domains', lambda: self._call('list_domains', **kwargs), **kwargs)
 
     def list_operations(self, **kwargs) -> dict:
-        return self.client.list_operations(**kwargs)
+        return self._cached('list_operations', lambda: self._call('list_operations', **kwargs), **kwargs)
 
     def get_domain_detail(self, domain_name) -> dict:
-        return self.client.get_domain_detail(DomainName = domain_name)
+        try:
+            return self._cached(
+                'get_domain_detail',
+                lambda: self._call('get_domain_detail', DomainName = domain_name),
+                DomainName = domain_name
+            )
+        except Exception as e:
+            # The registrar answers InvalidInput for a domain it doesn't
+            # hold for this account.
+            if error_code(e) == 'InvalidInput':
+                raise DomainNotFound(domain_name) from e
+            raise
 
     def get_operation_detail(self, operation_id) -> dict:
-        return self.client.get_operation_detail(OperationId = operation_id)
+        return self._call('get_operation_detail', OperationId = operation_id)
 
     def check_domain_availability(self, domain_name) -> dict:
-        return self.client.check_domain_availability(DomainName = domain_name)
+        return self._call('check_domain_availability', DomainName = domain_name)
 
     def register_domain(self, **kwargs) -> dict:
-        return self.client.register_domain(**kwargs)
+        response = self._call('register_domain', **kwargs)
+        self._invalidate(kwargs['DomainName'], inventory = True)
+        return response
 
-    def update_domain_nameservers(self, domain_name: str, name_servers: List[str]) -> dict:
-        return self.client.update_domain_nameservers(
+    def update_domain_nameservers(self, domain_name: str, name_servers: List[NameServer]) -> dict:
+        response = self._call(
+            'update_domain_nameservers',
             DomainName = domain_name,
-            Nameservers = [{'Name': ns} for ns in name_servers]
+            Nameservers = [ns.to_boto() for ns in name_servers]
         )
+        self._invalidate(domain_name)
+        return response
 
     def check_domain_transferability(self, **kwargs) -> dict:
-        return self.client.check_domain_transferability(**kwargs)
+        return self._call('check_domain_transferability', **kwargs)
 
     def transfer_domain(self, **kwargs) -> dict:
-        return self.client.transfer_domain(**kwargs)
+        response = self._call('transfer_domain', **kwargs)
+        self._invalidate(kwargs['DomainName'], inventory = True)
+        return response
+
+    def list_prices(self, **kwargs) -> dict:
+        return self._call('list_prices', **kwargs)
 
     def update_domain_contact(self, domain_name: str, contact: Contact):
         updated_contact = contact.to_boto()
 
-        return self.client.update_domain_contact(
+        response = self._call(
+            'update_domain_contact',
             DomainName = domain_name,
             AdminContact = updated_contact,
             RegistrantContact = updated_contact,
             TechContact = updated_contact
         )
+        self._invalidate(domain_name)
+        return response
 
     def enable_domain_auto_renew(self, domain_name: str):
-        return self.client.enable_domain_auto_renew(DomainName = domain_name)
+        response = self._call('enable_domain_auto_renew', DomainName = domain_name)
+        self._invalidate(domain_name, inventory = True)
+        return response
 
     def disable_domain_auto_renew(self, domain_name: str):
-        return self.client.disable_domain_auto_renew(DomainName = domain_name)
+        response = self._call('disable_domain_auto_renew', DomainName = domain_name)
+        self._invalidate(domain_name, inventory = True)
+        return response
+
+
+THROTTLING_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'Throttling', 'RequestLimitExceeded'}
+
+
+def error_code(e: Exception) -> Optional[str]:
+    response = getattr(e, 'response', None) or {}
+    return response.get('Error', {}).get('Code')
+
+
+def is_throttling_error(e: Exception) -> bool:
+    return error_code(e) in THROTTLING_ERROR_CODES
+
+
+TRANSIENT_ERROR_CODES = {'InternalError', 'InternalFailure', 'ServiceUnavailable', 'RequestTimeout',
+                         'RequestTimeoutException', 'PriorRequestNotComplete'}
+TRANSIENT_STATUS_CODES = {500, 502, 503, 504}
+
+# Calls that can be repeated safely even if the registrar may have acted on
+# the failed attempt: a mutation that timed out waiting for its response
+# may have gone through, and repeating it could, say, register twice.
+IDEMPOTENT_METHODS = {'list_domains', 'list_operations', 'get_domain_detail', 'get_operation_detail',
+                      'check_domain_availability', 'check_domain_transferability', 'list_prices'}
+
+
+def is_transient_error(e: Exception) -> bool:
+    """A registrar-side failure (a 5xx), or a connection that failed,
+    dropped or timed out."""
+    from botocore.exceptions import ConnectionError, HTTPClientError
+
+    if isinstance(e, (ConnectionError, HTTPClientError)):
+        return True
+
+    status = (getattr(e, 'response', None) or {}).get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return error_code(e) in TRANSIENT_ERROR_CODES or status in TRANSIENT_STATUS_CODES
+
+
+def is_unsent_error(e: Exception) -> bool:
+    """A failure to connect, so the registrar never saw the request."""
+    from botocore.exceptions import ConnectTimeoutError, EndpointConnectionError
+
+    return isinstance(e, (ConnectTimeoutError, EndpointConnectionError))
+
+
+def is_retryable_error(method: str, e: Exception) -> bool:
+    """Throttles and requests that never reached the registrar are retried
+    for every method; other transient failures only for idempotent ones."""
+    return is_throttling_error(e) or is_unsent_error(e) or (method in IDEMPOTENT_METHODS and is_transient_error(e))
+
+
+# Upper bounds, in milliseconds, of the latency histogram buckets.
+LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# CloudWatch accepts at most 100 values per metric in one EMF record.
+EMF_MAX_VALUES = 100
+
+
+def emf_record(namespace: str, dimensions: List[List[str]], metrics: dict, units: dict,
+               properties: Optional[dict] = None, timestamp: Optional[int] = None) -> str:
+    """One CloudWatch Embedded Metric Format log line holding metrics
+    (name -> value, or a list of values) with their units (name -> unit).
+    properties are logged alongside them, and must include the value of
+    every dimension."""
+    return json.dumps(dict({
+        '_aws': {
+            'Timestamp': timestamp if timestamp is not None else int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': dimensions,
+                'Metrics': [{'Name': name, 'Unit': units[name]} for name in metrics]
+            }]
+        }
+    }, **(properties or {}), **metrics))
+
+
+@dataclass
+class CallStats:
+    calls: int = 0
+    errors: int = 0
+    throttles: int = 0
+    latencies_ms: List[float] = field(default_factory=list)
+
+    def histogram(self) -> dict:
+        buckets = {f"le_{bound}": 0 for bound in LATENCY_BUCKETS_MS}
+        buckets['gt_' + str(LATENCY_BUCKETS_MS[-1])] = 0
+
+        for latency in self.latencies_ms:
+            for bound in LATENCY_BUCKETS_MS:
+                if latency <= bound:
+                    buckets[f"le_{bound}"] += 1
+                    break
+            else:
+                buckets['gt_' + str(LATENCY_BUCKETS_MS[-1])] += 1
+
+        return buckets
+
+
+class InstrumentedDomainManager(DomainManager):
+    """Wraps any DomainManager, recording the call count, latencies and
+    throttle and error counts of every registrar method. emit_metrics()
+    writes them as CloudWatch Embedded Metric Format log lines and starts
+    over, so each invocation reports its own totals."""
+
+    # Calls that change what list_domains returns, and so the index.
+    INVENTORY_MUTATIONS = {'register_domain', 'transfer_domain', 'enable_domain_auto_renew', 'disable_domain_auto_renew'}
+
+    def __init__(self, inner: DomainManager, namespace: str = 'DomainResource'):
+        self.inner = inner
+        self.namespace = namespace
+        self.stats: dict = {}
+        self._lock = threading.Lock()
+        # Throttles the inner manager retries away are counted here; the
+        # one it finally gives up on is counted by _timed.
+        inner.on_throttle = self._count_throttle
+
+    def _count_throttle(self, method: str):
+        with self._lock:
+            self.stats.setdefault(method, CallStats()).throttles += 1
+
+    def set_deadline(self, deadline: Optional[float]):
+        super().set_deadline(deadline)
+        self.inner.set_deadline(deadline)
+
+    def _timed(self, method: str, *args, **kwargs):
+        started = time.perf_counter()
+        error = None
+
+        try:
+            return getattr(self.inner, method)(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            latency_ms = (time.perf_counter() - started) * 1000
+
+            with self._lock:
+                stats = self.stats.setdefault(method, CallStats())
+                stats.calls += 1
+                stats.latencies_ms.append(latency_ms)
+                # A domain that isn't in the account is an answer, not a
+                # failure: every Create of a new domain probes for it.
+                if error is not None and not isinstance(error, DomainNotFound):
+                    if is_throttling_error(error):
+                        stats.throttles += 1
+                    else:
+                        stats.errors += 1
+
+            if method in self.INVENTORY_MUTATIONS:
+                self.reset_domain_index()
+
+    def list_domains(self, **kwargs) -> dict:
+        return self._timed('list_domains', **kwargs)
+
+    def list_operations(self, **kwargs) -> dict:
+        return self._timed('list_operations', **kwargs)
+
+    def get_domain_detail(self, domain_name) -> dict:
+        return self._timed('get_domain_detail', domain_name)
+
+    def get_operation_detail(self, operation_id) -> dict:
+        return self._timed('get_operation_detail', operation_id)
+
+    def check_domain_availability(self, domain_name) -> dict:
+        return self._timed('check_domain_availability', domain_name)
+
+    def register_domain(self, **kwargs) -> dict:
+        return self._timed('register_domain', **kwargs)
+
+    def update_domain_nameservers(self, *args, **kwargs) -> dict:
+        return self._timed('update_domain_nameservers', *args, **kwargs)
+
+    def check_domain_transferability(self, **kwargs) -> dict:
+        return self._timed('check_domain_transferability', **kwargs)
+
+    def transfer_domain(self, **kwargs) -> dict:
+        return self._timed('transfer_domain', **kwargs)
+
+    def list_prices(self, **kwargs) -> dict:
+        return self._timed('list_prices', **kwargs)
+
+    def update_domain_contact(self, *args, **kwargs):
+        return self._timed('update_domain_contact', *args, **kwargs)
+
+    def enable_domain_auto_renew(self, *args, **kwargs):
+        return self._timed('enable_domain_auto_renew', *args, **kwargs)
+
+    def disable_domain_auto_renew(self, *args, **kwargs):
+        return self._timed('disable_domain_auto_renew', *args, **kwargs)
+
+    def emit_metrics(self, properties: Optional[dict] = None, emit: Callable[[str], None] = print):
+        """Writes one EMF record per registrar method called, dimensioned by
+        Method, and one with the invocation's totals, then resets the stats.
+        properties (e.g. the RequestType) are added to every record."""
+        with self._lock:
+            stats, self.stats = self.stats, {}
+
+        timestamp = int(time.time() * 1000)
+
+        def record(dimensions: List[List[str]], metrics: dict, units: dict, extra: dict) -> str:
+            return emf_record(self.namespace, dimensions, metrics, units, dict(properties or {}, **extra), timestamp)
+
+        units = {'Calls': 'Count', 'Errors': 'Count', 'Throttles': 'Count', 'Latency': 'Milliseconds',
+                 'RegistrarCalls': 'Count', 'RegistrarTime': 'Milliseconds'}
+
+        for method, method_stats in sorted(stats.items()):
+            emit(record(
+                [['Method']],
+                {
+                    'Calls': method_stats.calls,
+                    'Errors': method_stats.errors,
+                    'Throttles': method_stats.throttles,
+                    'Latency': [round(latency, 3) for latency in method_stats.latencies_ms[:EMF_MAX_VALUES]]
+                },
+                units,
+                {'Method': method, 'LatencyHistogram': method_stats.histogram()}
+            ))
+
+        if stats:
+            emit(record(
+                [[]],
+                {
+                    'RegistrarCalls': sum(method_stats.calls for method_stats in stats.values()),
+                    'RegistrarTime': round(sum(sum(method_stats.latencies_ms) for method_stats in stats.values()), 3),
+                    'Throttles': sum(method_stats.throttles for method_stats in stats.values()),
+                    'Errors': sum(method_stats.errors for method_stats in stats.values())
+                },
+                units,
+                {}
+            ))
+
+
+# When set, every registrar call is timed and counted, and each invocation
+# logs the totals in CloudWatch Embedded Metric Format.
+METRICS_ENABLED = os.environ.get('DOMAIN_METRICS_ENABLED', 'false').lower() == 'true'
+
+class DomainManagerPool:
+    """One DomainManager per target role, built on first use and kept for
+    the life of the container, so that a warm function serving many
+    accounts reuses each account's client, connections and credentials.
+    Requests without a role use default."""
+
+    def __init__(self, default: DomainManager, factory: Callable[[str], DomainManager]):
+        self.default = default
+        self.factory = factory
+        self._managers = {}
+        self._lock = threading.Lock()
+
+    def get(self, role_arn: Optional[str]) -> DomainManager:
+        if role_arn is None:
+            return self.default
+
+        with self._lock:
+            if role_arn not in self._managers:
+                self._managers[role_arn] = self.factory(role_arn)
+            return self._managers[role_arn]
+
+
+def role_domain_manager(role_arn: str) -> DomainManager:
+    # Every account has its own registrar rate limit, and its own domains,
+    # so it gets its own rate limiter and cache.
+    manager = DomainManagerLive(
+        cache=TtlCache(registrar_cache.ttl, registrar_cache.max_entries),
+        rate_limiter=TokenBucket(registrar_rate_limiter.max_rate, registrar_rate_limiter.burst),
+        role_arn=role_arn
+    )
+    if METRICS_ENABLED:
+        manager = InstrumentedDomainManager(manager)
+    return manager
 
 
+domain_manager = None
+domain_managers = None
+
 try:
     domain_manager = DomainManagerLive()
-    pass
+    if METRICS_ENABLED:
+        domain_manager = InstrumentedDomainManager(domain_manager)
+    domain_managers = DomainManagerPool(domain_manager, role_domain_manager)
 except Exception as e:
     helper.init_failure(e)
 
+# Shapes of the resource's properties, checked before any registrar call so
+# that a bad template fails straight away, with every problem listed, rather
+# than after availability and transferability round trips.
+CONTACT_REQUIRED_PROPERTIES = (
+    'firstName', 'lastName', 'addressLine1', 'city', 'state', 'countryCode', 'zipCode', 'phoneNumber', 'email'
+)
+CONTACT_TYPES = frozenset({'PERSON', 'COMPANY', 'ASSOCIATION', 'PUBLIC_BODY', 'RESELLER'})
+# The ISO 3166-1 alpha-2 codes the registrar accepts.
+COUNTRY_CODES = frozenset("""
+    AC AD AE AF AG AI AL AM AN AO AQ AR AS AT AU AW AX AZ BA BB BD BE BF BG BH BI BJ BL BM BN BO BQ BR BS BT BV
+    BW BY BZ CA CC CD CF CG CH CI CK CL CM CN CO CR CU CV CW CX CY CZ DE DJ DK DM DO DZ EC EE EG EH ER ES ET FI
+    FJ FK FM FO FR GA GB GD GE GF GG GH GI GL GM GN GP GQ GR GS GT GU GW GY HK HM HN HR HT HU ID IE IL IM IN IO
+    IQ IR IS IT JE JM JO JP KE KG KH KI KM KN KP KR KW KY KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME MF MG
+    MH MK ML MM MN MO MP MQ MR MS MT MU MV MW MX MY MZ NA NC NE NF NG NI NL NO NP NR NU NZ OM PA PE PF PG PH PK
+    PL PM PN PR PS PT PW PY QA RE RO RS RU RW SA SB SC SD SE SG SH SI SJ SK SL SM SN SO SR SS ST SV SX SY SZ TC
+    TD TF TG TH TJ TK TL TM TN TO TP TR TT TV TW TZ UA UG US UY UZ VA VC VE VG VI VN VU WF WS YE YT ZA ZM ZW
+""".split())
+PHONE_NUMBER_PATTERN = re.compile(r'\+\d{1,3}\.\d{1,26}')
+EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+HOSTNAME_LABEL = r'(?!-)[a-z0-9-]{1,63}(?<!-)'
+HOSTNAME_PATTERN = re.compile(rf'(?=.{{1,253}}$)(?:{HOSTNAME_LABEL}\.)+{HOSTNAME_LABEL}', re.IGNORECASE)
+BOOLEAN_VALUES = {'true': True, 'false': False}
+ROLE_ARN_PATTERN = re.compile(r'arn:aws[a-z-]*:iam::\d{12}:role/[\w+=,.@/-]+')
+ACCOUNT_ID_PATTERN = re.compile(r'\d{12}')
+
+# The role assumed in the account given by a resource's AccountId property.
+TARGET_ROLE_NAME = os.environ.get('DOMAIN_TARGET_ROLE_NAME', 'DomainResourceRole')
+
+
+def target_role_arn(properties: dict) -> Optional[str]:
+    """The role to manage the resource's domains as, from its RoleArn or
+    AccountId property, or None to use the function's own credentials."""
+    if properties.get('RoleArn'):
+        return str(properties['RoleArn'])
+    if properties.get('AccountId'):
+        return f"arn:aws:iam::{properties['AccountId']}:role/{TARGET_ROLE_NAME}"
+    return None
+
+
+def parse_bool(value) -> bool:
+    """CloudFormation hands custom resources every scalar as a string, so
+    AutoRenew: false arrives as 'false'."""
+    if isinstance(value, bool):
+        return value
+    return BOOLEAN_VALUES[str(value).lower()]
+
+
+def validate_contact(contact, prefix: str) -> List[str]:
+    if not isinstance(contact, dict):
+        return [f"{prefix} must be an object"]
+
+    errors = [f"{prefix}.{key} is required" for key in CONTACT_REQUIRED_PROPERTIES if key not in contact]
+
+    if 'type' in contact and contact['type'] not in CONTACT_TYPES:
+        errors.append(f"{prefix}.type {contact['type']!r} must be one of {', '.join(sorted(CONTACT_TYPES))}")
+    if 'countryCode' in contact and str(contact['countryCode']) not in COUNTRY_CODES:
+        errors.append(f"{prefix}.countryCode {contact['countryCode']!r} is not an ISO 3166 country code")
+    if 'phoneNumber' in contact and not PHONE_NUMBER_PATTERN.fullmatch(str(contact['phoneNumber'])):
+        errors.append(f"{prefix}.phoneNumber {contact['phoneNumber']!r} must look like +1.3035551212")
+    if 'email' in contact and not EMAIL_PATTERN.fullmatch(str(contact['email'])):
+        errors.append(f"{prefix}.email {contact['email']!r} is not an email address")
+
+    return errors
+
+
+def validate_properties(properties, prefix: str = "") -> List[str]:
+    """Returns every problem with the properties of a single domain, each
+    naming the property at fault, or an empty list if they can be parsed."""
+    if not isinstance(properties, dict):
+        return [f"{prefix or 'Properties'} must be an object"]
+
+    errors = []
+
+    if 'DomainName' not in properties:
+        errors.append(f"{prefix}DomainName is required")
+    elif not HOSTNAME_PATTERN.fullmatch(str(properties['DomainName'])):
+        errors.append(f"{prefix}DomainName {properties['DomainName']!r} is not a domain name")
+
+    if 'Contact' not in properties:
+        errors.append(f"{prefix}Contact is required")
+    else:
+        errors.extend(validate_contact(properties['Contact'], f"{prefix}Contact"))
+
+    if 'AutoRenew' in properties and str(properties['AutoRenew']).lower() not in BOOLEAN_VALUES:
+        errors.append(f"{prefix}AutoRenew {properties['AutoRenew']!r} must be true or false")
+
+    if 'DurationInYears' in properties:
+        duration = str(properties['DurationInYears'])
+        if not duration.isdigit() or int(duration) < 1:
+            errors.append(f"{prefix}DurationInYears {properties['DurationInYears']!r} must be a positive whole number")
+
+    name_servers = properties.get('NameServers', [])
+    if not isinstance(name_servers, list):
+        errors.append(f"{prefix}NameServers must be a list")
+    else:
+        for i, name_server in enumerate(name_servers):
+            errors.extend(validate_name_server(name_server, f"{prefix}NameServers[{i}]"))
+
+    return errors
+
+
+def validate_name_server(name_server, prefix: str) -> List[str]:
+    if not isinstance(name_server, dict):
+        name_server = {'Name': name_server}
+        name_prefix = prefix
+    else:
+        name_prefix = f"{prefix}.Name"
+
+    if 'Name' not in name_server:
+        return [f"{name_prefix} is required"]
+
+    errors = []
+    # A trailing dot (fully qualified form) is fine; it's dropped when parsed.
+    if not HOSTNAME_PATTERN.fullmatch(str(name_server['Name']).rstrip('.')):
+        errors.append(f"{name_prefix} {name_server['Name']!r} is not a host name")
+
+    glue_ips = name_server.get('GlueIps', [])
+    if not isinstance(glue_ips, list):
+        errors.append(f"{prefix}.GlueIps must be a list")
+    else:
+        for j, ip in enumerate(glue_ips):
+            try:
+                ipaddress.ip_address(str(ip))
+            except ValueError:
+                errors.append(f"{prefix}.GlueIps[{j}] {ip!r} is not an IP address")
+
+    return errors
+
+
+def validate_target(properties: dict) -> List[str]:
+    if 'RoleArn' in properties and 'AccountId' in properties:
+        return ["Only one of RoleArn and AccountId can be given"]
+    if 'RoleArn' in properties and not ROLE_ARN_PATTERN.fullmatch(str(properties['RoleArn'])):
+        return [f"RoleArn {properties['RoleArn']!r} is not an IAM role ARN"]
+    if 'AccountId' in properties and not ACCOUNT_ID_PATTERN.fullmatch(str(properties['AccountId'])):
+        return [f"AccountId {properties['AccountId']!r} must be a 12-digit AWS account ID"]
+    return []
+
+
+def validate_event_properties(properties: dict):
+    """Raises a ValueError listing every problem with the resource's
+    properties, whether they describe one domain or a fleet of them."""
+    errors = validate_target(properties)
+
+    if 'Domains' in properties:
+        seen = set()
+        for i, domain_properties in enumerate(properties['Domains']):
+            errors.extend(validate_properties(domain_properties, f"Domains[{i}]."))
+            domain_name = domain_properties.get('DomainName') if isinstance(domain_properties, dict) else None
+            if domain_name in seen:
+                errors.append(f"Domains[{i}].DomainName {domain_name!r} is listed more than once")
+            seen.add(domain_name)
+    else:
+        errors.extend(validate_properties(properties))
+
+    if errors:
+        raise ValueError("Invalid properties: " + "; ".join(errors))
+
+
 def parse_event(event):
+    return parse_properties(event['ResourceProperties'])
+
+
+def parse_properties(properties: dict):
     return DomainEvent(
-        domain_name=event['ResourceProperties']['DomainName'],
+        domain_name=properties['DomainName'],
         contact=Contact(
-            first_name=event['ResourceProperties']['Contact']['firstName'],
-            last_name=event['ResourceProperties']['Contact']['lastName'],
-            contact_type=event['ResourceProperties']['Contact'].get('type'),
-            address_line_1=event['ResourceProperties']['Contact']['addressLine1'],
-            city=event['ResourceProperties']['Contact']['city'],
-            state=event['ResourceProperties']['Contact']['state'],
-            country_code=event['ResourceProperties']['Contact']['countryCode'],
-            zip_code=event['ResourceProperties']['Contact']['zipCode'],
-            phone_number=event['ResourceProperties']['Contact']['phoneNumber'],
-            email=event['ResourceProperties']['Contact']['email']
+            first_name=properties['Contact']['firstName'],
+            last_name=properties['Contact']['lastName'],
+            contact_type=properties['Contact'].get('type'),
+            address_line_1=properties['Contact']['addressLine1'],
+            city=properties['Contact']['city'],
+            state=properties['Contact']['state'],
+            country_code=properties['Contact']['countryCode'],
+            zip_code=properties['Contact']['zipCode'],
+            phone_number=properties['Contact']['phoneNumber'],
+            email=properties['Contact']['email']
         ),
-        auto_renew=bool(event['ResourceProperties'].get('AutoRenew', True)),
-        name_servers=event['ResourceProperties'].get('NameServers', []),
-        duration_in_years=int(event['ResourceProperties'].get('DurationInYears', 1))
+        auto_renew=parse_bool(properties.get('AutoRenew', True)),
+        name_servers=[NameServer.from_property(ns) for ns in properties.get('NameServers', [])],
+        duration_in_years=int(properties['DurationInYears']) if 'DurationInYears' in properties else None,
+        transfer_auth_code=properties.get('TransferAuthCode')
     )
 
 def contacts_are_equal(new_contact: dict, old_contact: Contact):
@@ -196,18 +1436,416 @@ def contacts_are_equal(new_contact: dict, old_contact: Contact):
             new_contact.get("Email") == old_contact.email
     )
 
-def nameservers_are_equal(new_name_servers: List[str], old_name_servers: List[str]):
-    return set(new_name_servers) == set(old_name_servers)
+def nameservers_are_equal(new_name_servers: List[NameServer], old_name_servers: List[NameServer]):
+    """Whether the nameservers are the same, in any order. A new nameserver
+    given without glue IPs matches the old one whatever its glue."""
+    old_by_name = {ns.name: ns for ns in old_name_servers}
+    return (
+            {ns.name for ns in new_name_servers} == set(old_by_name) and
+            all(not ns.glue_ips or ns.glue_ips == old_by_name[ns.name].glue_ips for ns in new_name_servers)
+    )
+
+
+def with_current_glue(name_servers: List[NameServer], current: List[NameServer]) -> List[NameServer]:
+    """name_servers, with the glue IPs the registrar already has for any of
+    them given without, so that updating the list doesn't drop them."""
+    current_by_name = {ns.name: ns for ns in current}
+    return [ns if ns.glue_ips else current_by_name.get(ns.name, ns) for ns in name_servers]
+
+
+@dataclass
+class DomainChange:
+    name: str
+    apply: Callable[[], Any]
+
+
+# The attributes of a domain that can be changed after it's created.
+UPDATABLE_ATTRIBUTES = frozenset({'contact', 'auto_renew', 'name_servers'})
+
+
+def changed_attributes(properties: dict, old_properties: Optional[dict]) -> Optional[set]:
+    """Returns which UPDATABLE_ATTRIBUTES differ between a domain's old and
+    new resource properties, compared after parsing so that e.g. 2 and "2"
+    are equal. Returns None when that can't be told, in which case every
+    attribute has to be checked against the registrar."""
+    if old_properties is None:
+        return None
+
+    try:
+        old = parse_properties(old_properties)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    new = parse_properties(properties)
+
+    if old.domain_name != new.domain_name:
+        return None
+
+    changed = set()
+    if old.contact != new.contact:
+        changed.add('contact')
+    if old.auto_renew != new.auto_renew:
+        changed.add('auto_renew')
+    if not nameservers_are_equal(new.name_servers or [], old.name_servers or []):
+        changed.add('name_servers')
+
+    return changed
+
+
+def plan_domain_changes(manager: DomainManager, domain_event: DomainEvent, detail: dict,
+                        attributes: Optional[set] = None) -> List[DomainChange]:
+    """Compares the desired domain_event with the registrar's detail and
+    returns the registrar calls needed to converge them, looking only at
+    attributes if given. The changes are independent of each other and may
+    be applied in any order."""
+    domain_name = domain_event.domain_name
+    attributes = UPDATABLE_ATTRIBUTES if attributes is None else attributes
+    changes = []
+
+    if 'contact' in attributes:
+        admin_contact_same = contacts_are_equal(detail.get('AdminContact', {}), domain_event.contact)
+        registrant_contact_same = contacts_are_equal(detail.get('RegistrantContact', {}), domain_event.contact)
+        tech_contact_same = contacts_are_equal(detail.get('TechContact', {}), domain_event.contact)
+
+        if not admin_contact_same or not registrant_contact_same or not tech_contact_same:
+            changes.append(DomainChange(
+                'update_domain_contact',
+                lambda: manager.update_domain_contact(domain_name, domain_event.contact)
+            ))
+
+    if 'auto_renew' in attributes and domain_event.auto_renew != detail.get('AutoRenew', False):
+        if domain_event.auto_renew:
+            changes.append(DomainChange(
+                'enable_domain_auto_renew',
+                lambda: manager.enable_domain_auto_renew(domain_name)
+            ))
+        else:
+            changes.append(DomainChange(
+                'disable_domain_auto_renew',
+                lambda: manager.disable_domain_auto_renew(domain_name)
+            ))
+
+    if 'name_servers' in attributes and domain_event.name_servers:
+        old_nameservers = [NameServer.from_boto(ns) for ns in detail.get('Nameservers', [])]
+        if not nameservers_are_equal(domain_event.name_servers, old_nameservers):
+            name_servers = with_current_glue(domain_event.name_servers, old_nameservers)
+            changes.append(DomainChange(
+                'update_domain_nameservers',
+                lambda: manager.update_domain_nameservers(domain_name, name_servers)
+            ))
+
+    return changes
+
+
+class DomainChangeError(Exception):
+    pass
+
+
+def apply_domain_changes(domain_name: str, changes: List[DomainChange], max_workers: int = None):
+    """Applies changes, concurrently on up to max_workers threads
+    (DOMAIN_UPDATE_CONCURRENCY by default). Every change is attempted; if
+    any fail, a single DomainChangeError reports all of the failures. If
+    they all failed only for lack of time, DeadlineExceeded is raised
+    instead, so the work can be handed on to a follow-up poll."""
+    if max_workers is None:
+        max_workers = DOMAIN_UPDATE_CONCURRENCY
+
+    errors = []
+
+    if len(changes) <= 1 or max_workers <= 1:
+        for change in changes:
+            try:
+                change.apply()
+            except Exception as e:
+                errors.append((change.name, e))
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(changes))) as executor:
+            futures = [(change.name, executor.submit(change.apply)) for change in changes]
+            for name, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    errors.append((name, e))
+
+    if errors and all(isinstance(e, DeadlineExceeded) for _, e in errors):
+        raise DeadlineExceeded(
+            f"No time left to update domain {domain_name}: " + ", ".join(name for name, _ in errors)
+        ) from errors[0][1]
+
+    if errors:
+        raise DomainChangeError(
+            f"Failed to update domain {domain_name}: " + "; ".join(f"{name}: {e}" for name, e in errors)
+        )
+
+
+def domain_event_to_dict(domain_event: DomainEvent) -> dict:
+    """The desired state of a domain, without its transfer auth code."""
+    state = asdict(domain_event)
+    state.pop('transfer_auth_code', None)
+    return state
+
+
+def domain_event_from_dict(state: dict) -> DomainEvent:
+    return DomainEvent(**dict(
+        state,
+        contact=Contact(**state['contact']),
+        # Older records hold bare nameserver names.
+        name_servers=[
+            NameServer(ns['name'], tuple(ns['glue_ips'])) if isinstance(ns, dict) else NameServer(ns)
+            for ns in state.get('name_servers') or []
+        ]
+    ))
+
+
+class DesiredStateStore(ABC):
+    """Where Create and Update record each domain's desired state, for
+    drift_handler to check the registrar against later."""
+
+    @abstractmethod
+    def put(self, domain_events: List[DomainEvent]):
+        pass
+
+    @abstractmethod
+    def remove(self, domain_names: List[str]):
+        pass
+
+    @abstractmethod
+    def all(self) -> List[DomainEvent]:
+        pass
+
+
+class JsonFileDesiredStateStore(DesiredStateStore):
+    """Keeps the desired states in one JSON file. Writes hold an exclusive
+    lock on a sibling .lock file and replace the file atomically, so
+    concurrent invocations sharing the file (e.g. on EFS) don't lose each
+    other's updates."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read(self) -> dict:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _update(self, change: Callable[[dict], None]):
+        import fcntl
+
+        with open(self.path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            states = self._read()
+            change(states)
+            temporary_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, 'w') as f:
+                json.dump(states, f, sort_keys=True)
+            os.replace(temporary_path, self.path)
+
+    def put(self, domain_events: List[DomainEvent]):
+        def change(states: dict):
+            for domain_event in domain_events:
+                states[domain_event.domain_name] = domain_event_to_dict(domain_event)
+
+        self._update(change)
+
+    def remove(self, domain_names: List[str]):
+        def change(states: dict):
+            for domain_name in domain_names:
+                states.pop(domain_name, None)
+
+        self._update(change)
+
+    def all(self) -> List[DomainEvent]:
+        return [domain_event_from_dict(state) for state in self._read().values()]
+
+
+class SqliteDesiredStateStore(DesiredStateStore):
+    """Keeps the desired states in a SQLite database, one row per domain."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _connect(self):
+        import sqlite3
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS desired_state (domain_name TEXT PRIMARY KEY, state TEXT NOT NULL)'
+        )
+        return connection
+
+    def put(self, domain_events: List[DomainEvent]):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'INSERT OR REPLACE INTO desired_state (domain_name, state) VALUES (?, ?)',
+                    [(domain_event.domain_name, json.dumps(domain_event_to_dict(domain_event)))
+                     for domain_event in domain_events]
+                )
+        finally:
+            connection.close()
+
+    def remove(self, domain_names: List[str]):
+        connection = self._connect()
+        try:
+            with connection:
+                connection.executemany(
+                    'DELETE FROM desired_state WHERE domain_name = ?',
+                    [(domain_name,) for domain_name in domain_names]
+                )
+        finally:
+            connection.close()
+
+    def all(self) -> List[DomainEvent]:
+        connection = self._connect()
+        try:
+            rows = connection.execute('SELECT state FROM desired_state ORDER BY domain_name').fetchall()
+        finally:
+            connection.close()
+        return [domain_event_from_dict(json.loads(state)) for state, in rows]
+
+
+def open_desired_state_store(path: Optional[str]) -> Optional[DesiredStateStore]:
+    """A SQLite store for a .db, .sqlite or .sqlite3 path, a JSON file store
+    for any other, or None without a path."""
+    if not path:
+        return None
+    if path.endswith(('.db', '.sqlite', '.sqlite3')):
+        return SqliteDesiredStateStore(path)
+    return JsonFileDesiredStateStore(path)
+
+
+desired_state_store = open_desired_state_store(os.environ.get('DESIRED_STATE_PATH'))
+
+
+def record_desired_state(domain_events: List[DomainEvent], role_arn: Optional[str] = None):
+    # Recording is best effort: it must not fail the stack operation.
+    if desired_state_store is None or not domain_events:
+        return
+    try:
+        desired_state_store.put([replace(domain_event, role_arn=role_arn) for domain_event in domain_events])
+    except Exception as e:
+        logger.error("Could not record the desired state of %d domains: %s", len(domain_events), e, exc_info=True)
+
+
+def forget_desired_state(domain_names: List[str]):
+    # Domains no longer managed stop being checked for drift; best effort,
+    # like recording.
+    if desired_state_store is None or not domain_names:
+        return
+    try:
+        desired_state_store.remove(domain_names)
+    except Exception as e:
+        logger.error("Could not remove the desired state of %s: %s", domain_names, e, exc_info=True)
+
 
-# todo: create should not try to transfer domains already being transferred
 # todo: create & update should do the same things?
 
 @helper.create
 @helper.update
 def create_or_update(event, context):
+    validate_event_properties(event['ResourceProperties'])
+
+    try:
+        if 'Domains' in event['ResourceProperties']:
+            return create_or_update_fleet(event, context)
+        return create_or_update_domain(event, context)
+    except DeadlineExceeded as e:
+        if not POLL_MODE:
+            raise DeadlineExceeded(
+                f"{e}: the function ran out of time. Raise its timeout, or set DOMAIN_POLL_MODE so the work "
+                f"can carry on in a follow-up invocation"
+            ) from e
+
+        # Re-running is safe: the next poll reconciles against whatever the
+        # registrar has by then, and a registration or transfer this
+        # invocation started is found in flight rather than started again.
+        logger.info("Out of time (%s); the next poll picks the work back up.", e)
+        helper.Data['Resume'] = True
+        if 'Domains' in event['ResourceProperties']:
+            return fleet_physical_resource_id(event)
+        return event['ResourceProperties']['DomainName']
+
+
+def create_or_update_domain(event, context):
     domain_event = parse_event(event)
+    attributes = update_attributes(event.get('RequestType'), event['ResourceProperties'], event.get('OldResourceProperties'))
+
+    if attributes is not None and not attributes:
+        logger.info("No change to the properties of domain %s; nothing to update.", domain_event.domain_name)
+        # CloudFormation only keeps the attributes of the latest response,
+        # so they're refreshed even when nothing changes.
+        detail = domain_manager.probe_domain_detail(domain_event.domain_name)
+        if detail is not None:
+            helper.Data.update(domain_attributes(detail))
+        record_desired_state([domain_event], target_role_arn(event['ResourceProperties']))
+        return domain_event.domain_name
+
+    domain_manager.reset_domain_index()
     domain_or_operation = domain_manager.get_domain_or_operation(domain_event.domain_name)
 
+    operation_id = reconcile_domain(
+        domain_manager, domain_event, domain_or_operation, event.get('RequestType'),
+        defer_nameservers = POLL_MODE, attributes = attributes
+    )
+    if operation_id:
+        helper.Data['OperationId'] = operation_id
+    if isinstance(domain_or_operation, dict):
+        helper.Data.update(domain_attributes(domain_or_operation, domain_event))
+
+    record_desired_state([domain_event], target_role_arn(event['ResourceProperties']))
+
+    return domain_event.domain_name
+
+
+def domain_attributes(detail: dict, domain_event: Optional[DomainEvent] = None) -> dict:
+    """The Fn::GetAtt attributes of a domain resource, from the registrar's
+    detail of the domain. Every attribute is always present, as a string
+    (lists are comma-separated). Given the domain_event just reconciled, its
+    auto-renew and nameservers are reported, as the detail predates them."""
+    def date(value) -> str:
+        return value.isoformat() if isinstance(value, datetime) else str(value or "")
+
+    name_servers = [NameServer.from_boto(ns).name for ns in detail.get('Nameservers', [])]
+    auto_renew = detail.get('AutoRenew', False)
+    if domain_event is not None:
+        auto_renew = domain_event.auto_renew
+        if domain_event.name_servers:
+            name_servers = [ns.name for ns in domain_event.name_servers]
+
+    return {
+        'DomainName': detail.get('DomainName', ""),
+        'CreationDate': date(detail.get('CreationDate')),
+        'ExpirationDate': date(detail.get('ExpirationDate')),
+        'Status': ",".join(detail.get('StatusList', [])),
+        'AutoRenew': str(auto_renew).lower(),
+        'TransferLock': str(bool(detail.get('StatusList') and 'clientTransferProhibited' in detail['StatusList'])).lower(),
+        'NameServers': ",".join(name_servers),
+        'RegistrarName': detail.get('RegistrarName', ""),
+        'RegistrarUrl': detail.get('RegistrarUrl', "")
+    }
+
+
+def update_attributes(request_type: Optional[str], properties: dict, old_properties: Optional[dict]) -> Optional[set]:
+    """For an Update, the attributes whose properties changed and so need
+    to be checked against the registrar; None (check everything) for other
+    requests, or for every Update in verify mode."""
+    if request_type != 'Update' or VERIFY_ON_UPDATE:
+        return None
+    return changed_attributes(properties, old_properties)
+
+
+def reconcile_domain(manager: DomainManager, domain_event: DomainEvent, domain_or_operation: Optional[dict | str],
+                     request_type: Optional[str], defer_nameservers: bool = False,
+                     attributes: Optional[set] = None) -> Optional[str]:
+    """Brings one domain in line with domain_event, given what
+    get_domain_or_operation found for it. Returns the OperationId of a
+    register or transfer operation that is still in flight, if any. With
+    defer_nameservers, a new registration's nameservers are left for
+    poll_create_or_update to set once it has completed. An existing domain
+    is only checked for the given attributes, if any."""
     if domain_or_operation is None:
         # On Update, the domain was tracked by CloudFormation in the past
         # but is no longer in our account (e.g. it was allowed to expire).
@@ -215,23 +1853,25 @@ def create_or_update(event, context):
         # of what the operator intended. Log and return success so the stack
         # update can proceed; the resource lingers in the stack as a no-op
         # until the operator removes it from the template.
-        if event.get('RequestType') == 'Update':
+        if request_type == 'Update':
             logger.warning(
                 "Domain %s is no longer in this account (likely expired). "
                 "Skipping re-registration on Update.",
                 domain_event.domain_name
             )
-            return domain_event.domain_name
+            return None
 
-        transfer_auth_code = event['ResourceProperties'].get('TransferAuthCode')
+        transfer_auth_code = domain_event.transfer_auth_code
+
+        duration_in_years = resolve_duration(manager, domain_event, transfer = transfer_auth_code is not None)
 
         if transfer_auth_code is None:
-            availability = domain_manager.check_domain_availability(domain_event.domain_name)
+            availability = manager.check_domain_availability(domain_event.domain_name)
 
             if availability['Availability'] == 'AVAILABLE':
-                domain_manager.register_domain(
+                response = manager.register_domain(
                     DomainName = domain_event.domain_name,
-                    DurationInYears = domain_event.duration_in_years,
+                    DurationInYears = duration_in_years,
                     AutoRenew = domain_event.auto_renew,
                     AdminContact = domain_event.contact.to_boto(),
                     RegistrantContact = domain_event.contact.to_boto(),
@@ -241,12 +1881,14 @@ def create_or_update(event, context):
                     PrivacyProtectTechContact = True
                 )
 
-                if domain_event.name_servers:
-                    domain_manager.update_domain_nameservers(domain_event.domain_name, domain_event.name_servers)
+                if domain_event.name_servers and not defer_nameservers:
+                    manager.update_domain_nameservers(domain_event.domain_name, domain_event.name_servers)
+
+                return (response or {}).get('OperationId')
             else:
                 raise Exception(f"Domain {domain_event.domain_name} is not available")
         else:
-            transferability = domain_manager.check_domain_transferability(
+            transferability = manager.check_domain_transferability(
                 DomainName = domain_event.domain_name,
                 AuthCode = transfer_auth_code
             )
@@ -255,7 +1897,7 @@ def create_or_update(event, context):
                 params = {
                     'DomainName': domain_event.domain_name,
                     'AuthCode': transfer_auth_code,
-                    'DurationInYears': domain_event.duration_in_years,
+                    'DurationInYears': duration_in_years,
                     'AutoRenew': domain_event.auto_renew,
                     'AdminContact': domain_event.contact.to_boto(),
                     'RegistrantContact': domain_event.contact.to_boto(),
@@ -266,39 +1908,218 @@ def create_or_update(event, context):
                 }
 
                 if domain_event.name_servers:
-                    params['Nameservers'] = [{'Name': ns} for ns in domain_event.name_servers]
+                    params['Nameservers'] = [ns.to_boto() for ns in domain_event.name_servers]
 
-                domain_manager.transfer_domain(**params)
+                response = manager.transfer_domain(**params)
+                return (response or {}).get('OperationId')
             else:
                 raise Exception(f"Domain {domain_event.domain_name} is not transferable")
     elif isinstance(domain_or_operation, str):
-        # pending transfer
-        pass
+        # pending registration or transfer
+        return domain_or_operation
     else:
-        admin_contact_same = contacts_are_equal(domain_or_operation.get('AdminContact', {}), domain_event.contact)
-        registrant_contact_same = contacts_are_equal(domain_or_operation.get('RegistrantContact', {}), domain_event.contact)
-        tech_contact_same = contacts_are_equal(domain_or_operation.get('TechContact', {}), domain_event.contact)
+        apply_domain_changes(
+            domain_event.domain_name,
+            plan_domain_changes(manager, domain_event, domain_or_operation, attributes)
+        )
 
-        if not admin_contact_same or not registrant_contact_same or not tech_contact_same:
-            domain_manager.update_domain_contact(domain_event.domain_name, domain_event.contact)
+    return None
+
+
+def fleet_request_types(event) -> dict:
+    """Maps each domain in a fleet to the request type it sees: a domain
+    that was already in the fleet before this Update is updated, one that
+    was just added is created."""
+    previous = fleet_old_properties(event)
+    request_type = event.get('RequestType')
+
+    return {
+        properties['DomainName']: 'Update' if request_type == 'Update' and properties['DomainName'] in previous else 'Create'
+        for properties in event['ResourceProperties']['Domains']
+    }
+
+
+def fleet_old_properties(event) -> dict:
+    old_domains = event.get('OldResourceProperties', {}).get('Domains', [])
+    return {properties.get('DomainName'): properties for properties in old_domains}
+
+
+def create_or_update_fleet(event, context):
+    """Reconciles every entry of the Domains property, each shaped like the
+    properties of a single domain resource. The inventory and in-flight
+    registrations and transfers are read once for the whole fleet, then the
+    domains are reconciled on up to DOMAIN_FLEET_CONCURRENCY threads. On Update, domains
+    whose properties didn't change are skipped. Every domain is attempted;
+    the event fails if any of them did."""
+    request_types = fleet_request_types(event)
+    old_properties = fleet_old_properties(event)
+
+    domain_events = []
+    domain_attributes = {}
+    for properties in event['ResourceProperties']['Domains']:
+        domain_name = properties['DomainName']
+        attributes = update_attributes(request_types[domain_name], properties, old_properties.get(domain_name))
+
+        if attributes is not None and not attributes:
+            logger.info("Domain %s: unchanged", domain_name)
+            continue
+
+        domain_events.append(parse_properties(properties))
+        domain_attributes[domain_name] = attributes
+
+    inventory = {}
+    pending_operations = {}
+    if domain_events:
+        inventory = {
+            domain['DomainName']: domain
+            for domains in domain_manager.iter_domain_pages()
+            for domain in domains
+        }
+        for operation in domain_manager.iter_pending_operations():
+            pending_operations.setdefault(operation['DomainName'], operation['OperationId'])
 
+    def reconcile(domain_event: DomainEvent):
+        if domain_event.domain_name in inventory:
+            domain_or_operation = domain_manager.get_domain_detail(domain_event.domain_name)
+        else:
+            domain_or_operation = pending_operations.get(domain_event.domain_name)
 
-        if domain_event.auto_renew != domain_or_operation.get('AutoRenew', False):
-            if domain_event.auto_renew:
-                domain_manager.enable_domain_auto_renew(domain_event.domain_name)
-            else:
-                domain_manager.disable_domain_auto_renew(domain_event.domain_name)
+        return reconcile_domain(
+            domain_manager, domain_event, domain_or_operation, request_types[domain_event.domain_name],
+            attributes = domain_attributes[domain_event.domain_name]
+        )
 
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, DOMAIN_FLEET_CONCURRENCY)) as executor:
+        futures = [(domain_event.domain_name, executor.submit(reconcile, domain_event)) for domain_event in domain_events]
+        for domain_name, future in futures:
+            try:
+                operation_id = future.result()
+                logger.info("Domain %s: SUCCESS%s", domain_name, f" (operation {operation_id})" if operation_id else "")
+            except Exception as e:
+                logger.error("Domain %s: FAILED: %s", domain_name, e)
+                failures.append((domain_name, e))
+
+    failed_domains = {domain_name for domain_name, _ in failures}
+    record_desired_state([
+        parse_properties(properties) for properties in event['ResourceProperties']['Domains']
+        if properties['DomainName'] not in failed_domains
+    ], target_role_arn(event['ResourceProperties']))
+    # Domains dropped from the fleet are left intact, as on Delete, but no
+    # longer managed.
+    forget_desired_state([domain_name for domain_name in old_properties if domain_name not in request_types])
+
+    helper.Data['Succeeded'] = len(event['ResourceProperties']['Domains']) - len(failures)
+    helper.Data['Failed'] = len(failures)
+
+    if failures and all(isinstance(e, DeadlineExceeded) for _, e in failures):
+        raise DeadlineExceeded(
+            f"{len(failures)} of {len(event['ResourceProperties']['Domains'])} domains weren't reached in time: " +
+            ", ".join(domain_name for domain_name, _ in failures)
+        )
 
-        if domain_event.name_servers:
-            old_nameservers = [ns.get('Name') for ns in domain_or_operation.get('Nameservers', [])]
-            nameservers_same = nameservers_are_equal(domain_event.name_servers, old_nameservers)
-            if not nameservers_same:
-                domain_manager.update_domain_nameservers(domain_event.domain_name, domain_event.name_servers)
+    if failures:
+        raise Exception(
+            f"{len(failures)} of {len(event['ResourceProperties']['Domains'])} domains failed: " +
+            "; ".join(f"{domain_name}: {e}" for domain_name, e in failures)
+        )
+
+    return fleet_physical_resource_id(event)
+
+
+def fleet_physical_resource_id(event) -> str:
+    return event.get('PhysicalResourceId') or event.get('LogicalResourceId', 'DomainFleet')
+
+
+def wait_for_operation(operation_id: str, budget_seconds: float, sleep=time.sleep) -> dict:
+    """Checks operation_id with get_operation_detail, backing off between
+    checks, until it leaves the pending states or budget_seconds is spent.
+    Returns the last operation detail seen."""
+    deadline = time.monotonic() + budget_seconds
+    delay = OPERATION_WAIT_INITIAL_DELAY_SECONDS
+
+    while True:
+        operation = domain_manager.get_operation_detail(operation_id)
+
+        if operation.get('Status') not in PENDING_OPERATION_STATUSES or time.monotonic() + delay > deadline:
+            return operation
+
+        sleep(delay)
+        delay = min(delay * 2, OPERATION_WAIT_MAX_DELAY_SECONDS)
+
+
+def operation_wait_budget(context) -> float:
+    if context is None:
+        return OPERATION_WAIT_SECONDS
+    # Leave time for crhelper to send the response.
+    remaining = context.get_remaining_time_in_millis() / 1000.0 - 3
+    return max(0.0, min(OPERATION_WAIT_SECONDS, remaining))
+
+
+def poll_create_or_update(event, context):
+    """crhelper poll function: runs every polling interval after a Create or
+    Update until it returns a physical resource id (SUCCESS) or raises
+    (FAILED). Returning None keeps polling, as does running out of time.
+
+    crhelper hands every poll the Data the Create or Update returned with,
+    not what an earlier poll changed. So while Resume is set each poll
+    re-runs the Create or Update, which picks up whatever operation an
+    earlier poll started, and then waits on that operation itself."""
+    try:
+        if helper.Data.pop('Resume', False):
+            logger.info("Resuming the work the Create or Update ran out of time for")
+            helper.Data.pop('OperationId', None)
+            create_or_update(event, context)
+            if helper.Data.get('Resume'):
+                return None
+
+        if 'Domains' in event['ResourceProperties']:
+            # Fleets don't wait for their registrar operations.
+            return helper.Data.get('PhysicalResourceId') or fleet_physical_resource_id(event)
+
+        domain_event = parse_event(event)
+        operation_id = helper.Data.get('OperationId')
+
+        if operation_id is None:
+            return domain_event.domain_name
+
+        operation = wait_for_operation(operation_id, operation_wait_budget(context))
+    except DeadlineExceeded as e:
+        logger.info("Out of time (%s); trying again on the next poll.", e)
+        return None
+
+    status = operation.get('Status')
+
+    if status in PENDING_OPERATION_STATUSES:
+        logger.info("Operation %s for domain %s is still %s", operation_id, domain_event.domain_name, status)
+        return None
+
+    if status != 'SUCCESSFUL':
+        raise Exception(
+            f"Operation {operation_id} for domain {domain_event.domain_name} ended with status {status}: "
+            f"{operation.get('Message', '')}"
+        )
+
+    try:
+        if operation.get('Type') == 'REGISTER_DOMAIN' and domain_event.name_servers:
+            domain_manager.update_domain_nameservers(domain_event.domain_name, domain_event.name_servers)
+
+        # The domain is in the account now, so its attributes can be reported.
+        detail = domain_manager.probe_domain_detail(domain_event.domain_name)
+        if detail is not None:
+            helper.Data.update(domain_attributes(detail, domain_event))
+    except DeadlineExceeded as e:
+        logger.info("Out of time (%s); finishing on the next poll.", e)
+        return None
 
     return domain_event.domain_name
 
 
+if POLL_MODE:
+    helper.poll_create(poll_create_or_update)
+    helper.poll_update(poll_create_or_update)
+
+
 @helper.delete
 def delete(event, context):
     # Intentionally a no-op. We never want this custom resource to actively
@@ -306,10 +2127,349 @@ def delete(event, context):
     # registrar operation. Removing the resource from the stack only stops
     # CloudFormation from tracking it; the domain itself is left in place
     # (and can be allowed to expire by setting AutoRenew=false beforehand).
-    domain_name = event.get('ResourceProperties', {}).get('DomainName')
-    logger.info("Delete requested for domain %s; no-op (domain left intact).", domain_name)
-    return domain_name
+    properties = event.get('ResourceProperties', {})
+    domain_names = [domain.get('DomainName') for domain in properties.get('Domains', [])] or [properties.get('DomainName')]
+    logger.info("Delete requested for %s; no-op (domains left intact).", ", ".join(map(str, domain_names)))
+
+    # The domains are no longer managed, so stop checking them for drift.
+    forget_desired_state(domain_names)
+
+    if 'Domains' in properties:
+        return fleet_physical_resource_id(event)
+    return properties.get('DomainName')
+
+
+def lambda_deadline(context) -> Optional[float]:
+    if context is None:
+        return None
+    return time.monotonic() + context.get_remaining_time_in_millis() / 1000.0 - DEADLINE_MARGIN_SECONDS
+
+
+# When set, Delete is acknowledged straight away by respond_to_delete,
+# rather than through crhelper, which sleeps for up to sleep_on_delete
+# seconds on every Delete so that its logs reach CloudWatch before a stack
+# deleting the function also deletes its log group.
+FAST_DELETE = os.environ.get('DOMAIN_FAST_DELETE', 'true').lower() == 'true'
+
+RESPONSE_CONNECT_TIMEOUT_SECONDS = 2
+RESPONSE_READ_TIMEOUT_SECONDS = 5
+RESPONSE_ATTEMPTS = 3
+# The watchdog fails the event this long before the Lambda times out.
+RESPONSE_WATCHDOG_MARGIN_SECONDS = 1
+
+_response_pool = None
+
+
+def response_pool():
+    """A urllib3 pool for responses to CloudFormation, kept for the life of
+    the container so warm invocations reuse its connections."""
+    global _response_pool
+    if _response_pool is None:
+        import urllib3
+
+        _response_pool = urllib3.PoolManager(
+            timeout=urllib3.Timeout(connect=RESPONSE_CONNECT_TIMEOUT_SECONDS, read=RESPONSE_READ_TIMEOUT_SECONDS),
+            retries=urllib3.Retry(total=RESPONSE_ATTEMPTS - 1, backoff_factor=0.2, allowed_methods=['PUT'],
+                                  status_forcelist=[500, 502, 503, 504])
+        )
+    return _response_pool
+
+
+def send_response(event, status: str, physical_resource_id: Optional[str], reason: str = "", data: dict = None):
+    """PUTs a custom resource response to the event's ResponseURL, in the
+    shape crhelper sends."""
+    body = json.dumps({
+        'Status': status,
+        'PhysicalResourceId': physical_resource_id,
+        'StackId': event['StackId'],
+        'RequestId': event['RequestId'],
+        'LogicalResourceId': event['LogicalResourceId'],
+        # CloudFormation rejects longer reasons.
+        'Reason': reason if len(reason) <= 256 else "ERROR: (truncated) " + reason[-240:],
+        'Data': data or {}
+    })
+    response = response_pool().request(
+        'PUT', event['ResponseURL'], body=body, headers={'Content-Type': '', 'Content-Length': str(len(body))}
+    )
+    logger.info("CloudFormation returned status code: %s", response.status)
+
+
+def respond_to_delete(event, context):
+    """Runs delete and acknowledges the Delete immediately, without the
+    registrar client or crhelper. A watchdog reports FAILED if delete is
+    still running just before the Lambda would time out."""
+    sent = threading.Lock()
+    physical_resource_id = event.get('PhysicalResourceId')
+
+    def respond(status, reason=""):
+        if sent.acquire(blocking=False):
+            send_response(event, status, physical_resource_id, reason)
+
+    watchdog = None
+    if context is not None:
+        watchdog = threading.Timer(
+            context.get_remaining_time_in_millis() / 1000.0 - RESPONSE_WATCHDOG_MARGIN_SECONDS,
+            respond, ('FAILED', "Execution timed out")
+        )
+        watchdog.daemon = True
+        watchdog.start()
+
+    try:
+        resource_id = delete(event, context)
+        physical_resource_id = physical_resource_id or resource_id
+        respond('SUCCESS')
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        respond('FAILED', str(e))
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
 
 
 def handler(event, context):
-    helper(event, context)
+    global domain_manager
+
+    if FAST_DELETE and event.get('RequestType') == 'Delete':
+        try:
+            return respond_to_delete(event, context)
+        finally:
+            cold_start.report()
+
+    try:
+        # Left to crhelper to report if the module failed to initialize.
+        if domain_managers is not None:
+            domain_manager = domain_managers.get(target_role_arn(event.get('ResourceProperties', {})))
+            domain_manager.set_deadline(lambda_deadline(context))
+        helper(event, context)
+    finally:
+        cold_start.report()
+        if isinstance(domain_manager, InstrumentedDomainManager):
+            domain_manager.emit_metrics({'RequestType': event.get('RequestType')})
+
+
+
+def drift_handler(event, context):
+    """Entry point for a scheduled drift check. Compares the desired state
+    recorded in the DESIRED_STATE_PATH store with the registrar, using the
+    same comparison as Create and Update, and logs every domain that has
+    drifted. With Repair set in the event (or DRIFT_REPAIR), the drift is
+    also corrected. Domains managed in other accounts are checked through
+    their role. Details are fetched on up to DRIFT_CONCURRENCY threads;
+    domains not reached before the Lambda runs out of time are reported as
+    skipped. Returns a summary of the run."""
+    if desired_state_store is None:
+        raise Exception("DESIRED_STATE_PATH is not set; there is no desired state to check")
+
+    repair = str(event.get('Repair', DRIFT_REPAIR)).lower() == 'true'
+    deadline = lambda_deadline(context)
+
+    desired_by_role = {}
+    for domain_event in desired_state_store.all():
+        desired_by_role.setdefault(domain_event.role_arn, {})[domain_event.domain_name] = domain_event
+
+    report = {
+        'Checked': 0,
+        'Drifted': {},
+        'Repaired': [],
+        'Missing': [],
+        'Failed': {},
+        'Skipped': []
+    }
+    lock = threading.Lock()
+
+    # Each account's domains are paged through once, by its own manager.
+    owned = []
+    for role_arn, desired in desired_by_role.items():
+        try:
+            manager = domain_manager if role_arn is None else domain_managers.get(role_arn)
+            manager.set_deadline(deadline)
+            owned_names = {
+                domain['DomainName']
+                for domains in manager.iter_domain_pages()
+                for domain in domains
+                if domain['DomainName'] in desired
+            }
+        except DeadlineExceeded as e:
+            logger.warning("Out of time listing the domains of %s: %s", role_arn or "this account", e)
+            report['Skipped'].extend(desired)
+            continue
+        except Exception as e:
+            logger.error("Could not list the domains of %s: %s", role_arn or "this account", e)
+            report['Failed'].update((domain_name, str(e)) for domain_name in desired)
+            continue
+
+        owned.extend((manager, desired[domain_name]) for domain_name in sorted(owned_names))
+        report['Missing'].extend(sorted(set(desired) - owned_names))
+
+    def check(manager: DomainManager, domain_event: DomainEvent):
+        domain_name = domain_event.domain_name
+
+        if deadline is not None and time.monotonic() > deadline:
+            with lock:
+                report['Skipped'].append(domain_name)
+            return
+
+        try:
+            changes = plan_domain_changes(manager, domain_event, manager.get_domain_detail(domain_name))
+            if changes and repair:
+                apply_domain_changes(domain_name, changes)
+        except DeadlineExceeded:
+            # Registrar calls stop being admitted a little before the
+            # deadline itself.
+            with lock:
+                report['Skipped'].append(domain_name)
+            return
+        except Exception as e:
+            logger.error("Domain %s: drift check failed: %s", domain_name, e)
+            with lock:
+                report['Failed'][domain_name] = str(e)
+            return
+
+        with lock:
+            report['Checked'] += 1
+            if changes:
+                logger.warning("Domain %s has drifted: %s", domain_name, ", ".join(change.name for change in changes))
+                report['Drifted'][domain_name] = [change.name for change in changes]
+                if repair:
+                    report['Repaired'].append(domain_name)
+
+    with ThreadPoolExecutor(max_workers=max(1, DRIFT_CONCURRENCY)) as executor:
+        list(executor.map(lambda item: check(*item), owned))
+
+    report['Missing'].sort()
+    report['Skipped'].sort()
+    for domain_name in report['Missing']:
+        logger.warning("Domain %s is recorded as managed but is not in its account", domain_name)
+
+    logger.info(
+        "Drift check: %d checked, %d drifted, %d repaired, %d missing, %d failed, %d skipped",
+        report['Checked'], len(report['Drifted']), len(report['Repaired']), len(report['Missing']),
+        len(report['Failed']), len(report['Skipped'])
+    )
+
+    return report
+
+
+# How far ahead renewal_watch_handler looks for expiring domains, and how
+# many of the soonest-expiring it checks in detail.
+RENEWAL_WINDOW_DAYS = float(os.environ.get('RENEWAL_WINDOW_DAYS', 30))
+RENEWAL_WATCH_MAX_DOMAINS = int(os.environ.get('RENEWAL_WATCH_MAX_DOMAINS', 100))
+
+# Statuses under which a domain won't simply renew itself.
+RENEWAL_RISK_STATUSES = frozenset({
+    'clientHold', 'serverHold', 'clientRenewProhibited', 'serverRenewProhibited', 'redemptionPeriod', 'pendingDelete'
+})
+
+
+def soonest_expiring(summaries: Iterator[dict], before: datetime, limit: int, ordered: bool = False) -> List[dict]:
+    """Returns, soonest first, up to limit of the domain summaries expiring
+    before the given time, holding no more than limit of them at once. If
+    the summaries are ordered by expiry (as iter_domains_by_expiry asks the
+    registrar for), reading stops at the first one past the window or once
+    limit are held."""
+    heap = []
+
+    for count, summary in enumerate(summaries):
+        expiry = summary.get('Expiry')
+        if expiry is None:
+            continue
+
+        if expiry > before:
+            if ordered:
+                break
+            continue
+
+        # A max-heap on expiry, so the latest-expiring is dropped when full.
+        heapq.heappush(heap, (-expiry.timestamp(), count, summary))
+        if len(heap) > limit:
+            heapq.heappop(heap)
+            if ordered:
+                break
+
+    return [summary for _, _, summary in sorted(heap, key=lambda entry: (-entry[0], entry[1]))]
+
+
+def renewal_watch_handler(event, context, emit: Callable[[str], None] = print):
+    """Entry point for a scheduled renewal check. Streams the account's
+    domains by expiry, keeping the soonest-expiring RENEWAL_WATCH_MAX_DOMAINS
+    of those within RENEWAL_WINDOW_DAYS (WindowDays and MaxDomains in the
+    event override them), and checks only those against get_domain_detail.
+    Domains that won't renew themselves, because auto-renew is off or their
+    status prevents it, are logged as warnings. Emits the counts as an EMF
+    record and returns a summary of the run."""
+    window_days = float(event.get('WindowDays', RENEWAL_WINDOW_DAYS))
+    limit = int(event.get('MaxDomains', RENEWAL_WATCH_MAX_DOMAINS))
+    deadline = lambda_deadline(context)
+    domain_manager.set_deadline(deadline)
+
+    now = datetime.now(timezone.utc)
+    expiring = soonest_expiring(
+        domain_manager.iter_domains_by_expiry(), now + timedelta(days=window_days), limit, ordered=True
+    )
+
+    report = {'Expiring': [], 'AtRisk': [], 'Missing': [], 'Skipped': []}
+
+    out_of_time = False
+
+    for summary in expiring:
+        domain_name = summary['DomainName']
+
+        if out_of_time or (deadline is not None and time.monotonic() > deadline):
+            report['Skipped'].append(domain_name)
+            continue
+
+        try:
+            detail = domain_manager.probe_domain_detail(domain_name)
+        except DeadlineExceeded as e:
+            # Registrar calls stop being admitted a little before the
+            # deadline itself; this domain and the rest are skipped.
+            logger.info("Out of time (%s); skipping the remaining domains", e)
+            out_of_time = True
+            report['Skipped'].append(domain_name)
+            continue
+
+        if detail is None:
+            report['Missing'].append(domain_name)
+            continue
+
+        expiry = detail.get('ExpirationDate') or summary['Expiry']
+        risks = sorted(RENEWAL_RISK_STATUSES.intersection(detail.get('StatusList', [])))
+        if not detail.get('AutoRenew', False):
+            risks.insert(0, 'AutoRenew disabled')
+
+        entry = {
+            'DomainName': domain_name,
+            'ExpirationDate': expiry.isoformat(),
+            'DaysLeft': round((expiry - now).total_seconds() / 86400, 1),
+            'Risks': risks
+        }
+        report['Expiring'].append(entry)
+
+        if risks:
+            report['AtRisk'].append(entry)
+            logger.warning(
+                "Domain %s expires in %.1f days (%s) and won't renew: %s",
+                domain_name, entry['DaysLeft'], entry['ExpirationDate'], ", ".join(risks)
+            )
+        else:
+            logger.info("Domain %s expires in %.1f days and will auto-renew", domain_name, entry['DaysLeft'])
+
+    logger.info(
+        "Renewal watch: %d expiring within %g days, %d at risk, %d missing, %d skipped",
+        len(report['Expiring']), window_days, len(report['AtRisk']), len(report['Missing']), len(report['Skipped'])
+    )
+
+    metrics = {
+        'ExpiringDomains': len(report['Expiring']),
+        'AtRiskDomains': len(report['AtRisk'])
+    }
+    if report['AtRisk']:
+        metrics['MinDaysToExpiry'] = min(entry['DaysLeft'] for entry in report['AtRisk'])
+    units = {'ExpiringDomains': 'Count', 'AtRiskDomains': 'Count', 'MinDaysToExpiry': 'None'}
+    emit(emf_record('DomainResource', [[]], metrics, units))
+
+    return report
+
+
+# Last, so the cold start breakdown covers the whole module body.
+cold_start.import_seconds = time.perf_counter() - _module_load_started
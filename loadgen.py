@@ -0,0 +1,507 @@
+"""Concurrent stack-deploy load generator for the Lambda handler.
+
+Simulates CloudFormation firing a stack's worth of domain custom resources at
+once: a Create, an Update and a Delete event per resource, each phase fired
+in one go. Events are handled by a pool of worker processes, each standing
+in for one Lambda container: it imports index cold, then runs handler() on
+one event at a time, as Lambda does. Registrar calls go over HTTP to
+RegistrarStub, a local Route 53 Domains stand-in with the account-wide rate
+limit of the real service, and crhelper's responses are PUT to a local
+ResponseSink instead of CloudFormation's S3 URL.
+
+For every phase it reports the p50/p99 time from the event being fired to
+its response arriving, the p50/p99 handler duration, the fraction of
+registrar calls throttled, and duplicate mutations: the same change sent to
+the registrar for the same domain more than once.
+
+    python loadgen.py --resources 200 --containers 50 --registrar-tps 5
+"""
+
+import argparse
+import functools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import threading
+import time
+import urllib.request
+import uuid
+from collections import Counter
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+if __name__ == '__main__':
+    # The generator itself runs locally: keep crhelper from building its polling clients.
+    os.environ.setdefault('AWS_SAM_LOCAL', 'true')
+
+from bench_all import _boto_contact, _contact
+from index import TokenBucket
+
+ACCOUNT_ID = "123456789012"
+
+REGISTRAR_MUTATIONS = frozenset({
+    'RegisterDomain', 'TransferDomain', 'UpdateDomainNameservers', 'UpdateDomainContact',
+    'EnableDomainAutoRenew', 'DisableDomainAutoRenew'
+})
+
+
+class RegistrarError(Exception):
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+class RegistrarStub:
+    """The state behind the registrar stand-in: the account's domains, its
+    operations (which complete as soon as they are submitted) and the
+    calls made, by action and by (mutation, domain)."""
+
+    def __init__(self, owned: List[str], name_servers: List[str], page_size: int = 20,
+                 latency: float = 0.0, max_tps: float = 5, burst: float = 5):
+        self.page_size = page_size
+        self.latency = latency
+        # Route 53 Domains throttles per account, however many containers
+        # are calling.
+        self.rate_limit = TokenBucket(max_rate=max_tps, burst=burst, min_rate=max_tps, increase=0)
+        self.lock = threading.Lock()
+        self.domains: Dict[str, dict] = {}
+        self.operations: List[dict] = []
+        self.reset_counters()
+
+        for domain_name in owned:
+            self._add_domain(domain_name, _boto_contact(_contact()), name_servers, auto_renew=True)
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = Counter()
+            self.throttled = 0
+            self.mutations = Counter()
+
+    def _add_domain(self, domain_name: str, contact: dict, name_servers: List[str], auto_renew: bool):
+        self.domains[domain_name] = {
+            'DomainName': domain_name,
+            'AdminContact': contact,
+            'RegistrantContact': contact,
+            'TechContact': contact,
+            'AutoRenew': auto_renew,
+            'Nameservers': [{'Name': name} for name in name_servers],
+            'ExpirationDate': time.time() + 365 * 86400
+        }
+
+    def _operation(self, operation_type: str, domain_name: str) -> dict:
+        operation = {
+            'OperationId': str(uuid.uuid4()),
+            'Status': 'SUCCESSFUL',
+            'Type': operation_type,
+            'DomainName': domain_name,
+            'SubmittedDate': time.time()
+        }
+        self.operations.append(operation)
+        return {'OperationId': operation['OperationId']}
+
+    def _detail(self, domain_name: str) -> dict:
+        if domain_name not in self.domains:
+            raise RegistrarError('InvalidInput', f"Domain {domain_name} not found in the account")
+        return self.domains[domain_name]
+
+    def _page(self, items: list, params: dict) -> dict:
+        start = int(params.get('Marker') or 0)
+        end = start + (params.get('MaxItems') or self.page_size)
+        page = {'Items': items[start:end]}
+        if end < len(items):
+            page['NextPageMarker'] = str(end)
+        return page
+
+    def call(self, action: str, params: dict) -> dict:
+        with self.lock:
+            self.calls[action] += 1
+            if not self.rate_limit.acquire(deadline=self.rate_limit.clock()):
+                self.throttled += 1
+                raise RegistrarError('ThrottlingException', "Rate exceeded")
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            if not hasattr(RegistrarStub, action) or not action[0].isupper():
+                raise RegistrarError('UnknownOperationException', f"{action} is not supported by the stub")
+            if action in REGISTRAR_MUTATIONS:
+                self.mutations[(action, params.get('DomainName'))] += 1
+            return getattr(self, action)(params)
+
+    def ListDomains(self, params: dict) -> dict:
+        domains = [
+            {'DomainName': name, 'AutoRenew': domain['AutoRenew'], 'Expiry': domain['ExpirationDate']}
+            for name, domain in sorted(self.domains.items())
+        ]
+        page = self._page(domains, params)
+        page['Domains'] = page.pop('Items')
+        return page
+
+    def ListOperations(self, params: dict) -> dict:
+        operations = [
+            operation for operation in self.operations
+            if ('Status' not in params or operation['Status'] in params['Status']) and
+               ('Type' not in params or operation['Type'] in params['Type']) and
+               ('SubmittedSince' not in params or operation['SubmittedDate'] >= params['SubmittedSince'])
+        ]
+        page = self._page(operations, params)
+        page['Operations'] = page.pop('Items')
+        return page
+
+    def GetDomainDetail(self, params: dict) -> dict:
+        return self._detail(params['DomainName'])
+
+    def GetOperationDetail(self, params: dict) -> dict:
+        for operation in self.operations:
+            if operation['OperationId'] == params['OperationId']:
+                return operation
+        raise RegistrarError('InvalidInput', f"Operation {params['OperationId']} not found")
+
+    def CheckDomainAvailability(self, params: dict) -> dict:
+        return {'Availability': 'UNAVAILABLE' if params['DomainName'] in self.domains else 'AVAILABLE'}
+
+    def CheckDomainTransferability(self, params: dict) -> dict:
+        return {'Transferability': {'Transferable': 'TRANSFERABLE'}}
+
+    def ListPrices(self, params: dict) -> dict:
+        price = {'Price': 14.0, 'Currency': 'USD'}
+        return {'Prices': [{
+            'Name': params.get('Tld', 'com'),
+            'RegistrationPrice': price,
+            'TransferPrice': price,
+            'RenewalPrice': price
+        }]}
+
+    def RegisterDomain(self, params: dict) -> dict:
+        if params['DomainName'] in self.domains:
+            raise RegistrarError('DomainLimitExceeded', f"Domain {params['DomainName']} is already registered")
+        self._add_domain(params['DomainName'], params['RegistrantContact'], [], params.get('AutoRenew', True))
+        return self._operation('REGISTER_DOMAIN', params['DomainName'])
+
+    def TransferDomain(self, params: dict) -> dict:
+        self._add_domain(params['DomainName'], params['RegistrantContact'],
+                         [name_server['Name'] for name_server in params.get('Nameservers', [])],
+                         params.get('AutoRenew', True))
+        return self._operation('TRANSFER_IN_DOMAIN', params['DomainName'])
+
+    def UpdateDomainNameservers(self, params: dict) -> dict:
+        self._detail(params['DomainName'])['Nameservers'] = params['Nameservers']
+        return self._operation('UPDATE_NAMESERVER', params['DomainName'])
+
+    def UpdateDomainContact(self, params: dict) -> dict:
+        detail = self._detail(params['DomainName'])
+        for role in ('AdminContact', 'RegistrantContact', 'TechContact'):
+            if role in params:
+                detail[role] = params[role]
+        return self._operation('UPDATE_DOMAIN_CONTACT', params['DomainName'])
+
+    def EnableDomainAutoRenew(self, params: dict) -> dict:
+        self._detail(params['DomainName'])['AutoRenew'] = True
+        return {}
+
+    def DisableDomainAutoRenew(self, params: dict) -> dict:
+        self._detail(params['DomainName'])['AutoRenew'] = False
+        return {}
+
+
+def _registrar_handler(stub: RegistrarStub):
+    """An HTTP handler speaking the JSON 1.1 protocol botocore uses for
+    Route 53 Domains: the action comes in the X-Amz-Target header."""
+
+    class RegistrarHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            action = self.headers['X-Amz-Target'].split('.')[-1]
+            params = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+            try:
+                status, body = 200, stub.call(action, params)
+            except RegistrarError as e:
+                status, body = 400, {'__type': e.code, 'message': str(e)}
+
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/x-amz-json-1.1')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    return RegistrarHandler
+
+
+class ResponseSink:
+    """Collects the responses crhelper sends to each event's ResponseURL,
+    with the time each arrived."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses: Dict[str, List[dict]] = {}
+
+    def record(self, request_id: str, body: dict):
+        with self.lock:
+            self.responses.setdefault(request_id, []).append(dict(body, ReceivedAt=time.time()))
+
+    def handler(self):
+        sink = self
+
+        class ResponseHandler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                sink.record(self.path.rsplit('/', 1)[-1], body)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return ResponseHandler
+
+
+def _serve(handler) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _url(server: ThreadingHTTPServer) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class LambdaContext:
+    def __init__(self, timeout: float):
+        self.aws_request_id = str(uuid.uuid4())
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self) -> int:
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def _put_response(response_url: str, response_body: dict, ssl_verify=None):
+    request = urllib.request.Request(response_url, data=json.dumps(response_body).encode(), method='PUT')
+    urllib.request.urlopen(request, timeout=10).read()
+
+
+_container = {}
+
+
+def _start_container(timeout: float, verbose: bool):
+    """Pool initializer: turns the worker process into a Lambda container."""
+    import index
+
+    if not verbose:
+        logging.root.addHandler(logging.NullHandler())
+
+    # crhelper only speaks HTTPS to the ResponseURL; the sink is plain HTTP.
+    index.helper._send = functools.partial(type(index.helper)._send, index.helper, send_response=_put_response)
+    _container.update(index=index, timeout=timeout, invocations=0)
+
+
+def _invoke(event: dict) -> dict:
+    index = _container['index']
+    cold = _container['invocations'] == 0
+    _container['invocations'] += 1
+
+    started = time.perf_counter()
+    index.handler(event, LambdaContext(_container['timeout']))
+    return {'RequestId': event['RequestId'], 'Seconds': time.perf_counter() - started, 'Cold': cold}
+
+
+@dataclass
+class PhaseResult:
+    phase: str
+    events: int
+    succeeded: int
+    failed: int
+    missing: int
+    duplicate_responses: int
+    cold_starts: int
+    response_ms: Dict[str, float]
+    handler_ms: Dict[str, float]
+    registrar_calls: int
+    throttled: int
+    duplicate_mutations: int
+    reasons: Counter = field(default_factory=Counter)
+
+    @property
+    def throttle_rate(self) -> float:
+        return self.throttled / self.registrar_calls if self.registrar_calls else 0.0
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+    ordered = sorted(values)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, math.ceil(p * len(ordered)) - 1))]
+
+    return {'p50': rank(0.50) * 1000, 'p99': rank(0.99) * 1000, 'max': ordered[-1] * 1000}
+
+
+def stack_events(phase: str, resources: int, sink_url: str, stack_id: str, changed: float) -> List[dict]:
+    """The events CloudFormation sends for one phase of the stack: a Create,
+    Update or Delete of resources domain resources. On Update, the first
+    changed fraction of them get new nameservers."""
+    events = []
+
+    for i in range(resources):
+        domain_name = f"load{i:04d}.com"
+        request_id = str(uuid.uuid4())
+        properties = {
+            'ServiceToken': f"arn:aws:lambda:us-east-1:{ACCOUNT_ID}:function:DomainFunction",
+            'DomainName': domain_name,
+            'Contact': _contact(),
+            'NameServers': ["ns1.example.com", "ns2.example.com"],
+            'AutoRenew': "true"
+        }
+        event = {
+            'RequestType': phase,
+            'ServiceToken': properties['ServiceToken'],
+            'ResponseURL': f"{sink_url}/responses/{request_id}",
+            'StackId': stack_id,
+            'RequestId': request_id,
+            'LogicalResourceId': f"Domain{i:04d}",
+            'ResourceType': "Custom::Domain",
+            'ResourceProperties': properties
+        }
+
+        if phase != 'Create':
+            event['PhysicalResourceId'] = domain_name
+        if phase == 'Update':
+            event['OldResourceProperties'] = dict(properties)
+            if i < resources * changed:
+                event['ResourceProperties'] = dict(properties, NameServers=["ns3.example.com", "ns4.example.com"])
+
+        events.append(event)
+
+    return events
+
+
+def run_phase(phase: str, events: List[dict], pool, stub: RegistrarStub, sink: ResponseSink,
+              wait_seconds: float) -> PhaseResult:
+    stub.reset_counters()
+    fired = time.time()
+    invocations = pool.map(_invoke, events, chunksize=1)
+
+    # Responses are sent before handler returns, but allow for stragglers.
+    deadline = time.monotonic() + wait_seconds
+    while time.monotonic() < deadline and any(event['RequestId'] not in sink.responses for event in events):
+        time.sleep(0.05)
+
+    responses = [sink.responses.get(event['RequestId'], []) for event in events]
+    firsts = [received[0] for received in responses if received]
+    statuses = Counter(response['Status'] for response in firsts)
+
+    return PhaseResult(
+        phase=phase,
+        events=len(events),
+        succeeded=statuses['SUCCESS'],
+        failed=statuses['FAILED'],
+        missing=sum(1 for received in responses if not received),
+        duplicate_responses=sum(len(received) - 1 for received in responses if received),
+        cold_starts=sum(1 for invocation in invocations if invocation['Cold']),
+        response_ms=percentiles([response['ReceivedAt'] - fired for response in firsts]),
+        handler_ms=percentiles([invocation['Seconds'] for invocation in invocations]),
+        registrar_calls=sum(stub.calls.values()),
+        throttled=stub.throttled,
+        duplicate_mutations=sum(count - 1 for count in stub.mutations.values() if count > 1),
+        reasons=Counter(response['Reason'] for response in firsts if response['Status'] == 'FAILED')
+    )
+
+
+def run(resources: int = 200, containers: int = 50, owned: float = 0.5, changed: float = 0.5,
+        registrar_tps: float = 5, registrar_burst: float = 5, latency: float = 0.05, timeout: float = 10,
+        environment: Optional[Dict[str, str]] = None, verbose: bool = False) -> List[PhaseResult]:
+    """Deploys, updates and deletes a stack of resources domain resources.
+    The first owned fraction of the domains are already in the account;
+    the rest are registered by the Create."""
+    stub = RegistrarStub(
+        owned=[f"load{i:04d}.com" for i in range(int(resources * owned))],
+        name_servers=["ns1.example.com", "ns2.example.com"],
+        latency=latency, max_tps=registrar_tps, burst=registrar_burst
+    )
+    sink = ResponseSink()
+    registrar = _serve(_registrar_handler(stub))
+    responses = _serve(sink.handler())
+
+    # Containers inherit the environment, and read it when importing index.
+    container_environment = dict({
+        'AWS_SAM_LOCAL': 'true',
+        'AWS_ACCESS_KEY_ID': 'loadgen',
+        'AWS_SECRET_ACCESS_KEY': 'loadgen',
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'REGISTRAR_ENDPOINT_URL': _url(registrar)
+    }, **(environment or {}))
+    saved_environment = {name: os.environ.get(name) for name in container_environment}
+    os.environ.update(container_environment)
+
+    stack_id = f"arn:aws:cloudformation:us-east-1:{ACCOUNT_ID}:stack/loadgen/{uuid.uuid4()}"
+    results = []
+
+    try:
+        with multiprocessing.get_context('spawn').Pool(containers, _start_container, (timeout, verbose)) as pool:
+            for phase in ('Create', 'Update', 'Delete'):
+                events = stack_events(phase, resources, _url(responses), stack_id, changed)
+                results.append(run_phase(phase, events, pool, stub, sink, wait_seconds=timeout))
+    finally:
+        for name, value in saved_environment.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        registrar.shutdown()
+        responses.shutdown()
+
+    return results
+
+
+def format_results(results: List[PhaseResult]) -> str:
+    lines = [
+        f"{'phase':<7} {'events':>6} {'ok':>5} {'failed':>6} {'missing':>7} {'cold':>5} "
+        f"{'resp p50':>9} {'resp p99':>9} {'hdlr p50':>9} {'hdlr p99':>9} "
+        f"{'calls':>6} {'throttled':>10} {'dup mut':>7} {'dup resp':>8}"
+    ]
+    for result in results:
+        lines.append(
+            f"{result.phase:<7} {result.events:>6} {result.succeeded:>5} {result.failed:>6} {result.missing:>7} "
+            f"{result.cold_starts:>5} {result.response_ms['p50']:>9.0f} {result.response_ms['p99']:>9.0f} "
+            f"{result.handler_ms['p50']:>9.0f} {result.handler_ms['p99']:>9.0f} {result.registrar_calls:>6} "
+            f"{result.throttle_rate:>9.1%} {result.duplicate_mutations:>7} {result.duplicate_responses:>8}"
+        )
+        for reason, count in result.reasons.most_common(3):
+            lines.append(f"        {count} x FAILED: {reason}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--resources', type=int, default=200, help="domain resources in the stack")
+    parser.add_argument('--containers', type=int, default=50, help="concurrent Lambda containers")
+    parser.add_argument('--owned', type=float, default=0.5, help="fraction of the domains already in the account")
+    parser.add_argument('--changed', type=float, default=0.5, help="fraction of the domains changed by the Update")
+    parser.add_argument('--registrar-tps', type=float, default=5, help="account-wide registrar rate limit")
+    parser.add_argument('--registrar-burst', type=float, default=5)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help="latency of every registrar call")
+    parser.add_argument('--timeout', type=float, default=10.0, help="Lambda timeout in seconds")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="environment variable for the containers, e.g. DOMAIN_LOOKUP_STRATEGY=list")
+    parser.add_argument('--verbose', action='store_true', help="show the containers' logs")
+    args = parser.parse_args(argv)
+
+    results = run(args.resources, args.containers, args.owned, args.changed, args.registrar_tps,
+                  args.registrar_burst, args.latency_ms / 1000.0, args.timeout,
+                  dict(variable.split('=', 1) for variable in args.env), args.verbose)
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
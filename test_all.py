@@ -1,4 +1,11 @@
+import json
+import time
+from datetime import datetime, timedelta, timezone
 import pytest
+from botocore.exceptions import ClientError
+import bench_all
+from bench_all import _contact
+import loadgen
 import index
 from index import DomainManager, DomainManagerLive
 
@@ -72,6 +79,13 @@ class DomainManagerFake(DomainManager):
         self.events.append("transfer_domain")
         self.transfer_kwargs = kwargs
 
+    def list_prices(self, **kwargs):
+        return {'Prices': [{
+            'Name': kwargs['Tld'],
+            'RegistrationPrice': {'Price': 14.0, 'Currency': 'USD'},
+            'TransferPrice': {'Price': 14.0, 'Currency': 'USD'}
+        }]}
+
 
 class DomainManagerRegisterFake(DomainManagerFake):
     """A fake that reports the domain as not yet owned and available, so
@@ -80,6 +94,9 @@ class DomainManagerRegisterFake(DomainManagerFake):
     def list_domains(self, **kwargs):
         return {'Domains': []}
 
+    def get_domain_detail(self, domain_name):
+        raise index.DomainNotFound(domain_name)
+
     def check_domain_availability(self, *args, **kwargs):
         return {'Availability': 'AVAILABLE'}
 
@@ -91,25 +108,13 @@ class DomainManagerTransferFake(DomainManagerFake):
     def list_domains(self, **kwargs):
         return {'Domains': []}
 
+    def get_domain_detail(self, domain_name):
+        raise index.DomainNotFound(domain_name)
+
     def check_domain_transferability(self, **kwargs):
         return {'Transferability': {'Transferable': 'TRANSFERABLE'}}
 
 
-def _contact():
-    return {
-        'firstName': "Joe",
-        'lastName': "Bob",
-        'type': "PERSON",
-        'phoneNumber': "+1.3035551212",
-        'email': "joe@bob.com",
-        'addressLine1': "PO Box 123",
-        'city': "Nowhere",
-        'state': "CA",
-        'countryCode': "US",
-        'zipCode': "91222"
-    }
-
-
 def test_exists():
     event = {
         'ResourceProperties': {
@@ -277,3 +282,1477 @@ def test_live_create_unavailable():
 
     with pytest.raises(Exception):
         index.create_or_update(event, None)
+
+
+class DomainManagerPagedFake(DomainManagerFake):
+    """A fake whose list_domains spreads the account's domains over several
+    pages, recording each page request."""
+
+    def __init__(self, domain_names, page_size=2):
+        super().__init__()
+        self.domain_names = domain_names
+        self.page_size = page_size
+        self.list_domains_markers = []
+
+    def list_domains(self, **kwargs):
+        marker = kwargs.get('Marker')
+        self.list_domains_markers.append(marker)
+        start = int(marker) if marker else 0
+        end = start + self.page_size
+        response = {'Domains': [{'DomainName': name} for name in self.domain_names[start:end]]}
+        if end < len(self.domain_names):
+            response['NextPageMarker'] = str(end)
+        return response
+
+
+def test_lookup_follows_pagination():
+    """A domain on a later page must be found, not treated as missing."""
+    domain_manager = DomainManagerPagedFake(["a.com", "b.com", "c.com", "d.com", "foo.com"])
+    domain_manager.lookup_strategy = 'list'
+
+    detail = domain_manager.get_domain_or_operation("foo.com")
+    assert detail['DomainName'] == "foo.com"
+    assert domain_manager.list_domains_markers == [None, "2", "4"]
+
+
+def test_lookup_stops_at_matching_page():
+    domain_manager = DomainManagerPagedFake(["a.com", "foo.com", "c.com", "d.com", "e.com"])
+
+    assert domain_manager.find_domain_summary("foo.com") == {'DomainName': "foo.com"}
+    assert domain_manager.list_domains_markers == [None]
+
+
+def test_lookup_index_answers_repeat_lookups():
+    domain_manager = DomainManagerPagedFake(["a.com", "b.com", "c.com", "d.com", "e.com"])
+
+    assert domain_manager.find_domain_summary("c.com") is not None
+    assert domain_manager.find_domain_summary("a.com") is not None
+    assert domain_manager.list_domains_markers == [None, "2"]
+
+    # A miss resumes from the last page seen, then is answered from the index.
+    assert domain_manager.find_domain_summary("missing.com") is None
+    assert domain_manager.find_domain_summary("missing.com") is None
+    assert domain_manager.list_domains_markers == [None, "2", "4"]
+
+
+def test_lookup_without_index_rescans():
+    domain_manager = DomainManagerPagedFake(["a.com", "b.com", "c.com"])
+    domain_manager.index_domains = False
+
+    domain_manager.find_domain_summary("c.com")
+    domain_manager.find_domain_summary("c.com")
+    assert domain_manager.list_domains_markers == [None, "2", None, "2"]
+
+
+class Route53DomainsClientStub:
+    """Stands in for the boto3 route53domains client, counting calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def list_domains(self, **kwargs):
+        self.calls.append('list_domains')
+        return {'Domains': [{'DomainName': "foo.com"}]}
+
+    def get_domain_detail(self, **kwargs):
+        self.calls.append('get_domain_detail')
+        return {'DomainName': kwargs['DomainName'], 'AutoRenew': True}
+
+    def enable_domain_auto_renew(self, **kwargs):
+        self.calls.append('enable_domain_auto_renew')
+        return {}
+
+    def update_domain_nameservers(self, **kwargs):
+        self.calls.append('update_domain_nameservers')
+        return {'OperationId': "op-1"}
+
+
+def _live_with_stub(monkeypatch, cache):
+    monkeypatch.setenv('AWS_DEFAULT_REGION', "us-east-1")
+    domain_manager = DomainManagerLive(cache = cache)
+    domain_manager.client = Route53DomainsClientStub()
+    return domain_manager
+
+
+def test_ttl_cache_expires_and_evicts():
+    now = [0.0]
+    cache = index.TtlCache(ttl = 10, max_entries = 2, clock = lambda: now[0])
+    loads = []
+
+    def load(value):
+        loads.append(value)
+        return value
+
+    cache.get_or_load('a', lambda: load('a'))
+    cache.get_or_load('a', lambda: load('a'))
+    assert loads == ['a']
+
+    now[0] = 11
+    cache.get_or_load('a', lambda: load('a'))
+    assert loads == ['a', 'a']
+
+    cache.get_or_load('b', lambda: load('b'))
+    cache.get_or_load('c', lambda: load('c'))
+    cache.get_or_load('a', lambda: load('a'))
+    assert loads == ['a', 'a', 'b', 'c', 'a']
+
+
+def test_live_reads_are_shared_across_managers(monkeypatch):
+    cache = index.TtlCache(ttl = 60, max_entries = 16)
+    first = _live_with_stub(monkeypatch, cache)
+    second = _live_with_stub(monkeypatch, cache)
+
+    first.lookup_strategy = second.lookup_strategy = 'list'
+
+    assert first.get_domain_or_operation("foo.com")['DomainName'] == "foo.com"
+    assert second.get_domain_or_operation("foo.com")['DomainName'] == "foo.com"
+    assert first.client.calls == ['list_domains', 'get_domain_detail']
+    assert second.client.calls == []
+
+
+def test_live_mutations_invalidate_cache(monkeypatch):
+    cache = index.TtlCache(ttl = 60, max_entries = 16)
+    domain_manager = _live_with_stub(monkeypatch, cache)
+    domain_manager.lookup_strategy = 'list'
+
+    domain_manager.get_domain_or_operation("foo.com")
+    domain_manager.update_domain_nameservers("foo.com", [index.NameServer("ns1.example.com")])
+    domain_manager.get_domain_detail("foo.com")
+    domain_manager.list_domains()
+    assert domain_manager.client.calls == [
+        'list_domains', 'get_domain_detail', 'update_domain_nameservers', 'get_domain_detail'
+    ]
+
+    domain_manager.enable_domain_auto_renew("foo.com")
+    domain_manager.list_domains()
+    assert domain_manager.client.calls[-2:] == ['enable_domain_auto_renew', 'list_domains']
+
+
+class DomainManagerPendingTransferFake(DomainManagerRegisterFake):
+    """A fake with a transfer of the domain still in flight on the second
+    page of operations, recording each list_operations request."""
+
+    def __init__(self):
+        super().__init__()
+        self.list_operations_kwargs = []
+
+    def list_operations(self, **kwargs):
+        self.list_operations_kwargs.append(kwargs)
+        if kwargs.get('Marker') is None:
+            return {
+                'Operations': [{
+                    'OperationId': "other-op",
+                    'Status': 'IN_PROGRESS',
+                    'Type': 'TRANSFER_IN_DOMAIN',
+                    'DomainName': "other.com"
+                }],
+                'NextPageMarker': "page-2"
+            }
+        return {
+            'Operations': [{
+                'OperationId': "transfer-op",
+                'Status': 'SUBMITTED',
+                'Type': 'TRANSFER_IN_DOMAIN',
+                'DomainName': "pending.com"
+            }]
+        }
+
+
+def test_pending_transfer_uses_server_side_filters():
+    domain_manager = DomainManagerPendingTransferFake()
+
+    assert domain_manager.get_domain_or_operation("pending.com") == "transfer-op"
+
+    first, second = domain_manager.list_operations_kwargs
+    assert first['Status'] == ['SUBMITTED', 'IN_PROGRESS']
+    assert first['Type'] == ['REGISTER_DOMAIN', 'TRANSFER_IN_DOMAIN']
+    assert first['SubmittedSince'] == index.pending_operations_since()
+    assert second['Marker'] == "page-2"
+
+
+def test_pending_transfer_blocks_second_transfer():
+    event = {
+        'RequestType': 'Create',
+        'ResourceProperties': {
+            'DomainName': "pending.com",
+            'Contact': _contact(),
+            'TransferAuthCode': "abc123"
+        }
+    }
+
+    index.domain_manager = DomainManagerPendingTransferFake()
+
+    index.create_or_update(event, None)
+    assert "transfer_domain" not in index.domain_manager.events
+    assert "register_domain" not in index.domain_manager.events
+
+
+def test_live_client_is_built_lazily(monkeypatch):
+    built = []
+    monkeypatch.setattr(DomainManagerLive, '_create_client', lambda self: built.append(1) or Route53DomainsClientStub())
+
+    domain_manager = DomainManagerLive()
+    assert built == []
+
+    domain_manager.list_domains()
+    domain_manager.list_domains(Marker = "next")
+    assert built == [1]
+
+
+def test_cold_start_report_logs_once(caplog):
+    timer = index.ColdStartTimer()
+    timer.import_seconds = 0.25
+
+    with caplog.at_level('INFO', logger = 'index'):
+        timer.report()
+        timer.report()
+
+    messages = [r.getMessage() for r in caplog.records if r.getMessage().startswith("Cold start")]
+    assert messages == ["Cold start: import 250.0ms, client build not run, first registrar call not run"]
+
+
+class DomainManagerOperationFake(DomainManagerRegisterFake):
+    """A fake whose register_domain starts an operation that reports the
+    given statuses, one per get_operation_detail call."""
+
+    def __init__(self, statuses):
+        super().__init__()
+        self.statuses = list(statuses)
+
+    def register_domain(self, **kwargs):
+        super().register_domain(**kwargs)
+        return {'OperationId': "register-op"}
+
+    def get_operation_detail(self, operation_id):
+        self.events.append("get_operation_detail")
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        return {'OperationId': operation_id, 'Status': status, 'Type': 'REGISTER_DOMAIN', 'Message': "nope"}
+
+
+def _poll_event(request_type='Create'):
+    return {
+        'RequestType': request_type,
+        'ResourceProperties': {
+            'DomainName': "fresh.com",
+            'Contact': _contact(),
+            'NameServers': ["ns1.example.com"]
+        }
+    }
+
+
+def test_poll_mode_tracks_operation_and_defers_nameservers(monkeypatch):
+    monkeypatch.setattr(index, 'POLL_MODE', True)
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerOperationFake(['IN_PROGRESS', 'SUCCESSFUL'])
+
+    assert index.create_or_update(_poll_event(), None) == "fresh.com"
+    assert index.helper.Data['OperationId'] == "register-op"
+    assert "update_domain_nameservers" not in index.domain_manager.events
+
+    assert index.poll_create_or_update(_poll_event(), None) == "fresh.com"
+    assert index.domain_manager.events.count("get_operation_detail") == 2
+    assert "update_domain_nameservers" in index.domain_manager.events
+
+
+def test_poll_keeps_polling_while_operation_pending(monkeypatch):
+    monkeypatch.setattr(index, 'OPERATION_WAIT_SECONDS', 0)
+    monkeypatch.setattr(index.helper, 'Data', {'OperationId': "register-op"})
+    index.domain_manager = DomainManagerOperationFake(['IN_PROGRESS'])
+
+    assert index.poll_create_or_update(_poll_event(), None) is None
+    assert index.domain_manager.events == ["get_operation_detail"]
+
+
+def test_poll_fails_when_operation_fails(monkeypatch):
+    monkeypatch.setattr(index.helper, 'Data', {'OperationId': "register-op"})
+    index.domain_manager = DomainManagerOperationFake(['FAILED'])
+
+    with pytest.raises(Exception, match="register-op.*FAILED: nope"):
+        index.poll_create_or_update(_poll_event(), None)
+
+
+class DomainManagerOutOfTimeFake(DomainManagerOperationFake):
+    """An operation fake that runs out of time on its first register_domain."""
+
+    def __init__(self, statuses):
+        super().__init__(statuses)
+        self.out_of_time = True
+
+    def register_domain(self, **kwargs):
+        if self.out_of_time:
+            self.out_of_time = False
+            raise index.DeadlineExceeded("No time left to call register_domain")
+        return super().register_domain(**kwargs)
+
+
+class DomainManagerRegistrationFake(DomainManagerOutOfTimeFake):
+    """An out-of-time fake that tracks the registration like the registrar
+    does: in flight, it's listed as a pending operation and the domain is
+    no longer available; once it succeeds, the domain is in the account."""
+
+    def __init__(self, statuses):
+        super().__init__(statuses)
+        self.registered = False
+        self.succeeded = False
+
+    def register_domain(self, **kwargs):
+        response = super().register_domain(**kwargs)
+        self.registered = True
+        return response
+
+    def get_operation_detail(self, operation_id):
+        operation = super().get_operation_detail(operation_id)
+        self.succeeded = operation['Status'] == 'SUCCESSFUL'
+        return operation
+
+    def list_operations(self, **kwargs):
+        if not self.registered or self.succeeded:
+            return {'Operations': []}
+        return {'Operations': [{'OperationId': "register-op", 'Status': 'IN_PROGRESS',
+                                'Type': 'REGISTER_DOMAIN', 'DomainName': "fresh.com"}]}
+
+    def get_domain_detail(self, domain_name):
+        if not self.succeeded:
+            raise index.DomainNotFound(domain_name)
+        return DomainManagerFake.get_domain_detail(self, domain_name)
+
+    def check_domain_availability(self, *args, **kwargs):
+        return {'Availability': 'UNAVAILABLE' if self.registered else 'AVAILABLE'}
+
+
+def test_poll_mode_resumes_work_that_ran_out_of_time(monkeypatch):
+    monkeypatch.setattr(index, 'POLL_MODE', True)
+    monkeypatch.setattr(index, 'OPERATION_WAIT_SECONDS', 0)
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerRegistrationFake(['IN_PROGRESS', 'SUCCESSFUL'])
+
+    assert index.create_or_update(_poll_event(), None) == "fresh.com"
+    assert index.helper.Data == {'Resume': True}
+
+    # crhelper freezes the Data into the polling rule once, so every poll
+    # starts from the same snapshot whatever the one before it changed.
+    snapshot = dict(index.helper.Data, PhysicalResourceId = "fresh.com")
+
+    monkeypatch.setattr(index.helper, 'Data', dict(snapshot))
+    assert index.poll_create_or_update(_poll_event(), None) is None
+    assert index.domain_manager.events == ["register_domain", "get_operation_detail"]
+
+    monkeypatch.setattr(index.helper, 'Data', dict(snapshot))
+    assert index.poll_create_or_update(_poll_event(), None) == "fresh.com"
+    assert index.domain_manager.events.count("register_domain") == 1
+    assert index.domain_manager.events[-2:] == ["get_operation_detail", "update_domain_nameservers"]
+    assert index.helper.Data['DomainName'] == "fresh.com"
+
+
+def test_running_out_of_time_without_poll_mode_fails_clearly(monkeypatch):
+    monkeypatch.setattr(index, 'POLL_MODE', False)
+    index.domain_manager = DomainManagerOutOfTimeFake(['SUCCESSFUL'])
+
+    with pytest.raises(index.DeadlineExceeded, match = "register_domain: the function ran out of time"):
+        index.create_or_update(_poll_event(), None)
+
+
+def test_wait_for_operation_backs_off():
+    delays = []
+    index.domain_manager = DomainManagerOperationFake(['SUBMITTED', 'IN_PROGRESS', 'SUCCESSFUL'])
+
+    operation = index.wait_for_operation("register-op", 60, sleep = delays.append)
+    assert operation['Status'] == 'SUCCESSFUL'
+    assert delays == [0.5, 1.0]
+
+
+class DomainManagerDriftedFake(DomainManagerFake):
+    """A fake whose domain differs from _contact() in every attribute, with
+    each mutation taking a while and optionally failing."""
+
+    def __init__(self, delay=0.0, failing=()):
+        super().__init__()
+        self.delay = delay
+        self.failing = failing
+
+    def get_domain_detail(self, domain_name):
+        detail = super().get_domain_detail(domain_name)
+        detail['AdminContact'] = dict(detail['AdminContact'], City="Elsewhere")
+        detail['AutoRenew'] = False
+        detail['Nameservers'] = [{'Name': "old.example.com"}]
+        return detail
+
+    def _mutate(self, name):
+        time.sleep(self.delay)
+        self.events.append(name)
+        if name in self.failing:
+            raise Exception(f"{name} rejected")
+
+    def update_domain_nameservers(self, *args, **kwargs):
+        self._mutate("update_domain_nameservers")
+
+    def update_domain_contact(self, *args, **kwargs):
+        self._mutate("update_domain_contact")
+
+    def enable_domain_auto_renew(self, *args, **kwargs):
+        self._mutate("enable_domain_auto_renew")
+
+
+def _drifted_event():
+    return {
+        'RequestType': 'Update',
+        'ResourceProperties': {
+            'DomainName': "foo.com",
+            'Contact': _contact(),
+            'AutoRenew': 'true',
+            'NameServers': ["ns1.example.com"]
+        }
+    }
+
+
+def test_update_applies_changes_concurrently():
+    index.domain_manager = DomainManagerDriftedFake(delay = 0.2)
+
+    started = time.monotonic()
+    index.create_or_update(_drifted_event(), None)
+    elapsed = time.monotonic() - started
+
+    assert sorted(index.domain_manager.events) == [
+        "enable_domain_auto_renew", "update_domain_contact", "update_domain_nameservers"
+    ]
+    assert elapsed < 0.5
+
+
+def test_update_reports_every_failed_change():
+    index.domain_manager = DomainManagerDriftedFake(failing = ("update_domain_contact", "update_domain_nameservers"))
+
+    with pytest.raises(index.DomainChangeError) as e:
+        index.create_or_update(_drifted_event(), None)
+
+    assert str(e.value) == (
+        "Failed to update domain foo.com: update_domain_contact: update_domain_contact rejected; "
+        "update_domain_nameservers: update_domain_nameservers rejected"
+    )
+    # The change that didn't fail was still applied.
+    assert "enable_domain_auto_renew" in index.domain_manager.events
+
+
+class DomainManagerFleetFake(DomainManagerFake):
+    """A fake owning foo.com, where any other domain is available except
+    taken.com, counting inventory reads."""
+
+    def __init__(self):
+        super().__init__()
+        self.registered = []
+        self.list_domains_calls = 0
+        self.list_operations_calls = 0
+
+    def list_domains(self, **kwargs):
+        self.list_domains_calls += 1
+        return super().list_domains(**kwargs)
+
+    def list_operations(self, **kwargs):
+        self.list_operations_calls += 1
+        return super().list_operations(**kwargs)
+
+    def check_domain_availability(self, domain_name):
+        return {'Availability': 'UNAVAILABLE' if domain_name == "taken.com" else 'AVAILABLE'}
+
+    def register_domain(self, **kwargs):
+        super().register_domain(**kwargs)
+        self.registered.append(kwargs['DomainName'])
+
+
+def _fleet_event(domain_names, old_domain_names=None):
+    event = {
+        'RequestType': 'Create',
+        'LogicalResourceId': "Domains",
+        'ResourceProperties': {
+            'Domains': [{'DomainName': name, 'Contact': _contact()} for name in domain_names]
+        }
+    }
+    if old_domain_names is not None:
+        event['RequestType'] = 'Update'
+        event['PhysicalResourceId'] = "Domains"
+        event['OldResourceProperties'] = {
+            'Domains': [{'DomainName': name, 'Contact': _contact()} for name in old_domain_names]
+        }
+    return event
+
+
+def test_fleet_reads_inventory_once(monkeypatch):
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerFleetFake()
+
+    response = index.create_or_update(_fleet_event(["foo.com", "a.com", "b.com"]), None)
+    assert response == "Domains"
+    assert sorted(index.domain_manager.registered) == ["a.com", "b.com"]
+    assert index.domain_manager.list_domains_calls == 1
+    assert index.domain_manager.list_operations_calls == 1
+    assert index.helper.Data == {'Succeeded': 3, 'Failed': 0}
+
+
+def test_fleet_reports_failed_domains(monkeypatch):
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerFleetFake()
+
+    with pytest.raises(Exception, match="1 of 2 domains failed: taken.com: Domain taken.com is not available"):
+        index.create_or_update(_fleet_event(["taken.com", "a.com"]), None)
+
+    assert index.domain_manager.registered == ["a.com"]
+    assert index.helper.Data == {'Succeeded': 1, 'Failed': 1}
+
+
+class DomainManagerFleetRegistrationFake(DomainManagerFleetFake):
+    """A fleet fake listing the domains it registered as in-flight
+    registrations, which runs out of time on its first registration of
+    late.com."""
+
+    def __init__(self):
+        super().__init__()
+        self.out_of_time = True
+
+    def list_operations(self, **kwargs):
+        self.list_operations_calls += 1
+        return {'Operations': [
+            {'OperationId': f"register-{name}", 'Status': 'IN_PROGRESS', 'Type': 'REGISTER_DOMAIN', 'DomainName': name}
+            for name in self.registered
+        ]}
+
+    def check_domain_availability(self, domain_name):
+        return {'Availability': 'UNAVAILABLE' if domain_name in self.registered else 'AVAILABLE'}
+
+    def register_domain(self, **kwargs):
+        if kwargs['DomainName'] == "late.com" and self.out_of_time:
+            self.out_of_time = False
+            raise index.DeadlineExceeded("No time left to call register_domain")
+        super().register_domain(**kwargs)
+
+
+def test_poll_mode_resumes_fleet_without_registering_twice(monkeypatch):
+    monkeypatch.setattr(index, 'POLL_MODE', True)
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerFleetRegistrationFake()
+
+    event = _fleet_event(["new.com", "late.com"])
+    physical_resource_id = index.create_or_update(event, None)
+    assert index.helper.Data['Resume'] is True
+    snapshot = dict(index.helper.Data)
+
+    for _ in range(2):
+        monkeypatch.setattr(index.helper, 'Data', dict(snapshot))
+        assert index.poll_create_or_update(event, None) == physical_resource_id
+
+    assert sorted(index.domain_manager.registered) == ["late.com", "new.com"]
+
+
+class DomainManagerNameserversOutOfTimeFake(DomainManagerFleetFake):
+    """A fleet fake owning foo.com whose nameserver updates always run out
+    of time."""
+
+    def update_domain_nameservers(self, *args, **kwargs):
+        self.events.append("update_domain_nameservers")
+        raise index.DeadlineExceeded("No time left to call update_domain_nameservers")
+
+
+def _nameservers_change(properties):
+    return (dict(properties, NameServers = ["ns2.example.com"]), dict(properties, NameServers = ["ns1.example.com"]))
+
+
+def test_poll_mode_resumes_update_that_ran_out_of_time(monkeypatch):
+    monkeypatch.setattr(index, 'POLL_MODE', True)
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerNameserversOutOfTimeFake()
+
+    new, old = _nameservers_change({'DomainName': "foo.com", 'Contact': _contact()})
+    event = {'RequestType': 'Update', 'ResourceProperties': new, 'OldResourceProperties': old}
+
+    assert index.create_or_update(event, None) == "foo.com"
+    assert index.helper.Data['Resume'] is True
+
+    # Still out of time on the next poll: keep polling rather than fail.
+    monkeypatch.setattr(index.helper, 'Data', {'Resume': True})
+    assert index.poll_create_or_update(event, None) is None
+    assert index.domain_manager.events == ["update_domain_nameservers"] * 2
+
+
+def test_poll_mode_resumes_fleet_update_that_ran_out_of_time(monkeypatch):
+    monkeypatch.setattr(index, 'POLL_MODE', True)
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerNameserversOutOfTimeFake()
+
+    new, old = _nameservers_change({'DomainName': "foo.com", 'Contact': _contact()})
+    event = _fleet_event([], old_domain_names = [])
+    event['ResourceProperties']['Domains'] = [new]
+    event['OldResourceProperties']['Domains'] = [old]
+
+    assert index.create_or_update(event, None) == "Domains"
+    assert index.helper.Data['Resume'] is True
+
+    monkeypatch.setattr(index.helper, 'Data', {'Resume': True})
+    assert index.poll_create_or_update(event, None) is None
+
+
+def test_fleet_update_registers_added_domains_only(monkeypatch):
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerFleetFake()
+
+    # expired.com was in the fleet before, so it's left alone like a single
+    # resource would be; new.com was just added, so it's registered.
+    event = _fleet_event(["expired.com", "new.com"], old_domain_names = ["expired.com"])
+    assert index.create_or_update(event, None) == "Domains"
+    assert index.domain_manager.registered == ["new.com"]
+
+
+def test_bench_update_is_a_single_lookup():
+    """Guards against inventory scans creeping back in: an Update of an
+    owned domain needs only its detail, however large the account."""
+    domain_manager = bench_all.DomainManagerBenchFake(domains = 5000, operations = 5000, page_size = 20)
+    scenario = bench_all.Scenario("update", 'Update', {
+        'DomainName': "domain04999.com",
+        'Contact': _contact(),
+        'NameServers': ["ns1.example.com"]
+    })
+
+    result = bench_all.run_scenario(scenario, domain_manager)
+    assert result.error is None
+    assert result.calls == {'get_domain_detail': 1}
+
+
+def test_bench_update_reads_inventory_until_match():
+    """Guards against extra or linear inventory scans: with the list lookup
+    strategy, an Update of the domain on the third page reads exactly three
+    pages and no operations."""
+    domain_manager = bench_all.DomainManagerBenchFake(domains = 100, operations = 5000, page_size = 20)
+    domain_manager.lookup_strategy = 'list'
+    scenario = bench_all.Scenario("update", 'Update', {
+        'DomainName': "domain00045.com",
+        'Contact': _contact(),
+        'NameServers': ["ns1.example.com"]
+    })
+
+    result = bench_all.run_scenario(scenario, domain_manager)
+    assert result.error is None
+    assert result.calls == {'list_domains': 3, 'get_domain_detail': 1}
+
+
+def test_bench_pending_transfer_ignores_operation_history():
+    results = {result.scenario: result for result in bench_all.run(domains = 40, operations = 5000)}
+
+    pending = results["create-pending-transfer"]
+    assert pending.error is None
+    assert pending.calls['list_operations'] == 1
+    assert 'transfer_domain' not in pending.calls
+    assert results["delete"].total_calls == 0
+
+
+def test_bench_retries_throttled_calls(monkeypatch):
+    monkeypatch.setattr(index, 'REGISTRAR_BACKOFF_BASE_SECONDS', 0.001)
+    monkeypatch.setattr(index, 'registrar_rate_limiter', index.TokenBucket(max_rate = 1000, burst = 1000))
+
+    results = bench_all.run(domains = 100, operations = 0, throttle_rate = 0.3, lookup_strategy = 'list')
+
+    assert [result.error for result in results] == [None] * len(results)
+    assert sum(result.throttles for result in results) > 0
+
+
+def test_concurrent_lookup_returns_first_match():
+    """A pending transfer is found on the first operations page, so the
+    concurrent lookup returns without waiting out the inventory scan, which
+    stops before its next page."""
+    domain_manager = bench_all.DomainManagerBenchFake(domains = 200, operations = 0, page_size = 20, latency = 0.02)
+    domain_manager.lookup_strategy = 'list'
+    domain_manager.concurrent_lookup = True
+
+    started = time.perf_counter()
+    assert domain_manager.get_domain_or_operation("pending.com") == "op-pending"
+    assert time.perf_counter() - started < 0.1
+
+    time.sleep(0.1)
+    assert domain_manager.calls['list_domains'] < 10
+
+
+def test_concurrent_lookup_finds_owned_domain():
+    domain_manager = bench_all.DomainManagerBenchFake(domains = 40, operations = 0)
+    domain_manager.concurrent_lookup = True
+
+    assert domain_manager.get_domain_or_operation("domain00039.com")['DomainName'] == "domain00039.com"
+    assert domain_manager.get_domain_or_operation("other.com") is None
+
+
+def test_instrumented_manager_emits_emf():
+    inner = bench_all.DomainManagerBenchFake(domains = 50, operations = 0, page_size = 20)
+    domain_manager = index.InstrumentedDomainManager(inner)
+    domain_manager.lookup_strategy = 'list'
+
+    assert domain_manager.get_domain_or_operation("domain00045.com")['DomainName'] == "domain00045.com"
+
+    inner.throttle_rate = 1.0
+    with pytest.raises(Exception):
+        domain_manager.register_domain(DomainName = "new.com")
+
+    lines = []
+    domain_manager.emit_metrics({'RequestType': 'Update'}, emit = lines.append)
+    records = [json.loads(line) for line in lines]
+
+    by_method = {record['Method']: record for record in records if 'Method' in record}
+    assert set(by_method) == {'list_domains', 'get_domain_detail', 'register_domain'}
+    assert by_method['list_domains']['Calls'] == 3
+    assert len(by_method['list_domains']['Latency']) == 3
+    assert sum(by_method['list_domains']['LatencyHistogram'].values()) == 3
+    assert by_method['register_domain']['Throttles'] == 1
+    assert by_method['register_domain']['Errors'] == 0
+
+    totals = records[-1]
+    assert totals['RegistrarCalls'] == 5
+    assert totals['Throttles'] == 1
+    assert totals['RequestType'] == 'Update'
+    assert totals['_aws']['CloudWatchMetrics'][0]['Namespace'] == 'DomainResource'
+
+    # Stats start over for the next invocation.
+    lines.clear()
+    domain_manager.emit_metrics(emit = lines.append)
+    assert lines == []
+
+
+def test_instrumented_manager_does_not_count_missing_domains_as_errors():
+    inner = bench_all.DomainManagerBenchFake(domains = 1, operations = 0)
+    domain_manager = index.InstrumentedDomainManager(inner)
+
+    assert domain_manager.probe_domain_detail("brand-new.com") is None
+
+    lines = []
+    domain_manager.emit_metrics(emit = lines.append)
+    records = [json.loads(line) for line in lines]
+
+    assert (records[0]['Method'], records[0]['Calls'], records[0]['Errors']) == ('get_domain_detail', 1, 0)
+    assert records[-1]['Errors'] == 0
+
+
+def test_instrumented_manager_counts_retried_throttles(monkeypatch):
+    inner = _live_with_throttling(monkeypatch, throttles = 2)
+    domain_manager = index.InstrumentedDomainManager(inner)
+
+    assert domain_manager.get_domain_detail("foo.com")['DomainName'] == "foo.com"
+
+    lines = []
+    domain_manager.emit_metrics(emit = lines.append)
+    records = [json.loads(line) for line in lines]
+
+    assert records[0]['Method'] == 'get_domain_detail'
+    assert records[0]['Calls'] == 1
+    assert records[0]['Throttles'] == 2
+    assert records[0]['Errors'] == 0
+    assert records[-1]['Throttles'] == 2
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_paces_and_adapts():
+    clock = FakeClock()
+    bucket = index.TokenBucket(max_rate = 4, burst = 2, min_rate = 0.5, increase = 1, clock = clock, sleep = clock.sleep)
+
+    for _ in range(4):
+        assert bucket.acquire()
+    # Two from the burst, then one every 1/4s.
+    assert clock.now == pytest.approx(0.5)
+
+    bucket.on_throttle()
+    bucket.on_throttle()
+    assert bucket.rate == 1
+    bucket.on_throttle()
+    bucket.on_throttle()
+    assert bucket.rate == 0.5
+
+    # The next token is 2s away, past the deadline.
+    assert not bucket.acquire(deadline = clock.now + 1)
+
+    bucket.on_success()
+    assert bucket.rate == 1.5
+
+
+class ThrottlingClientStub(Route53DomainsClientStub):
+    def __init__(self, throttles):
+        super().__init__()
+        self.throttles = throttles
+
+    def get_domain_detail(self, **kwargs):
+        if self.throttles:
+            self.throttles -= 1
+            self.calls.append('throttled')
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': "Rate exceeded"}}, 'GetDomainDetail')
+        return super().get_domain_detail(**kwargs)
+
+
+def _live_with_throttling(monkeypatch, throttles):
+    monkeypatch.setattr(index, 'REGISTRAR_BACKOFF_BASE_SECONDS', 0.001)
+    domain_manager = _live_with_stub(monkeypatch, index.TtlCache(ttl = 0, max_entries = 0))
+    domain_manager.rate_limiter = index.TokenBucket(max_rate = 1000, burst = 1000)
+    domain_manager.client = ThrottlingClientStub(throttles)
+    return domain_manager
+
+
+def test_live_retries_throttled_calls(monkeypatch):
+    domain_manager = _live_with_throttling(monkeypatch, throttles = 2)
+
+    assert domain_manager.get_domain_detail("foo.com")['DomainName'] == "foo.com"
+    assert domain_manager.client.calls == ['throttled', 'throttled', 'get_domain_detail']
+    # Two halvings, then one step back up.
+    assert domain_manager.rate_limiter.rate == pytest.approx(250.1)
+
+
+class FailingClientStub(Route53DomainsClientStub):
+    """Fails each method's first call with error."""
+
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    def _fail_once(self, method):
+        if method not in self.calls:
+            self.calls.append(method)
+            raise self.error
+
+    def get_domain_detail(self, **kwargs):
+        self._fail_once('get_domain_detail')
+        return super().get_domain_detail(**kwargs)
+
+    def update_domain_nameservers(self, **kwargs):
+        self._fail_once('update_domain_nameservers')
+        return super().update_domain_nameservers(**kwargs)
+
+
+def _server_error():
+    return ClientError({'Error': {'Code': 'InternalFailure', 'Message': "Internal failure"},
+                        'ResponseMetadata': {'HTTPStatusCode': 500}}, 'GetDomainDetail')
+
+
+def test_live_retries_transient_failures_of_reads(monkeypatch):
+    from botocore.exceptions import ReadTimeoutError
+
+    for error in (_server_error(), ReadTimeoutError(endpoint_url="https://route53domains")):
+        domain_manager = _live_with_throttling(monkeypatch, throttles = 0)
+        domain_manager.client = FailingClientStub(error)
+
+        assert domain_manager.get_domain_detail("foo.com")['DomainName'] == "foo.com"
+        assert domain_manager.client.calls == ['get_domain_detail', 'get_domain_detail']
+        # Only throttles slow the rate limiter down.
+        assert domain_manager.rate_limiter.rate == 1000
+
+
+def test_live_retries_mutations_only_when_unsent(monkeypatch):
+    from botocore.exceptions import EndpointConnectionError, ReadTimeoutError
+
+    name_servers = [index.NameServer("ns1.example.com")]
+
+    for error in (_server_error(), ReadTimeoutError(endpoint_url="https://route53domains")):
+        domain_manager = _live_with_throttling(monkeypatch, throttles = 0)
+        domain_manager.client = FailingClientStub(error)
+
+        with pytest.raises(type(error)):
+            domain_manager.update_domain_nameservers("foo.com", name_servers)
+        assert domain_manager.client.calls == ['update_domain_nameservers']
+
+    domain_manager.client = FailingClientStub(EndpointConnectionError(endpoint_url="https://route53domains"))
+    assert domain_manager.update_domain_nameservers("foo.com", name_servers) == {'OperationId': "op-1"}
+    assert domain_manager.client.calls == ['update_domain_nameservers', 'update_domain_nameservers']
+
+
+def test_live_stops_retrying_at_deadline(monkeypatch):
+    domain_manager = _live_with_throttling(monkeypatch, throttles = 100)
+    monkeypatch.setattr(index, 'REGISTRAR_BACKOFF_BASE_SECONDS', 10)
+    monkeypatch.setattr(index.random, 'uniform', lambda low, high: high)
+    domain_manager.set_deadline(time.monotonic() + index.REGISTRAR_MIN_CALL_SECONDS + 1)
+
+    with pytest.raises(index.DeadlineExceeded, match = "No time left to retry get_domain_detail"):
+        domain_manager.get_domain_detail("foo.com")
+    assert domain_manager.client.calls == ['throttled']
+
+
+def test_live_refuses_calls_past_deadline(monkeypatch):
+    domain_manager = _live_with_throttling(monkeypatch, throttles = 0)
+    domain_manager.rate_limiter = index.TokenBucket(max_rate = 1, burst = 1)
+    domain_manager.rate_limiter.acquire()
+    domain_manager.set_deadline(time.monotonic() + 0.1)
+
+    with pytest.raises(index.DeadlineExceeded):
+        domain_manager.get_domain_detail("foo.com")
+    assert domain_manager.client.calls == []
+
+
+def test_live_keeps_each_call_a_minimum_budget(monkeypatch):
+    domain_manager = _live_with_throttling(monkeypatch, throttles = 0)
+    monkeypatch.setattr(index, 'REGISTRAR_MIN_CALL_SECONDS', 0.5)
+
+    domain_manager.set_deadline(time.monotonic() + 0.4)
+    with pytest.raises(index.DeadlineExceeded):
+        domain_manager.get_domain_detail("foo.com")
+    assert domain_manager.client.calls == []
+
+    domain_manager.set_deadline(time.monotonic() + 1)
+    assert domain_manager.get_domain_detail("foo.com")['DomainName'] == "foo.com"
+
+
+def test_live_minimum_budget_covers_the_client_timeouts():
+    assert index.REGISTRAR_MIN_CALL_SECONDS >= index.REGISTRAR_CONNECT_TIMEOUT_SECONDS + index.REGISTRAR_READ_TIMEOUT_SECONDS
+
+
+class InvalidInputClientStub(Route53DomainsClientStub):
+    def get_domain_detail(self, **kwargs):
+        self.calls.append('get_domain_detail')
+        raise ClientError({'Error': {'Code': 'InvalidInput', 'Message': "Domain not found"}}, 'GetDomainDetail')
+
+    def list_operations(self, **kwargs):
+        self.calls.append('list_operations')
+        return {'Operations': []}
+
+
+def test_live_probe_treats_invalid_input_as_not_owned(monkeypatch):
+    domain_manager = _live_with_stub(monkeypatch, index.TtlCache(ttl = 60, max_entries = 16))
+    domain_manager.client = InvalidInputClientStub()
+
+    assert domain_manager.get_domain_or_operation("elsewhere.com") is None
+    assert domain_manager.client.calls == ['get_domain_detail', 'list_operations']
+
+
+def _update_event(properties, old_properties):
+    return {
+        'RequestType': 'Update',
+        'ResourceProperties': dict({'DomainName': "foo.com", 'Contact': _contact()}, **properties),
+        'OldResourceProperties': dict({'DomainName': "foo.com", 'Contact': _contact()}, **old_properties)
+    }
+
+
+def test_update_without_relevant_change_skips_registrar(monkeypatch):
+    # Only DurationInYears changed, and only in form.
+    monkeypatch.setattr(index.helper, 'Data', {})
+    event = _update_event({'AutoRenew': 'true', 'DurationInYears': "2"}, {'AutoRenew': 'true', 'DurationInYears': 2})
+    domain_manager = bench_all.DomainManagerBenchFake(domains = 1, operations = 0)
+    index.domain_manager = domain_manager
+
+    assert index.create_or_update(event, None) == "foo.com"
+    # Only the read that refreshes the resource's attributes.
+    assert domain_manager.calls == {'get_domain_detail': 1}
+
+
+def test_update_checks_only_changed_attributes():
+    # The registrar's contact has drifted, but only the nameservers changed
+    # in the template, so only they are updated.
+    index.domain_manager = DomainManagerDriftedFake()
+    event = _update_event(
+        {'AutoRenew': 'true', 'NameServers': ["ns1.example.com"]},
+        {'AutoRenew': 'true', 'NameServers': ["ns0.example.com"]}
+    )
+
+    index.create_or_update(event, None)
+    assert index.domain_manager.events == ["update_domain_nameservers"]
+
+
+def test_update_verify_mode_repairs_drift(monkeypatch):
+    monkeypatch.setattr(index, 'VERIFY_ON_UPDATE', True)
+    index.domain_manager = DomainManagerDriftedFake()
+    event = _update_event(
+        {'AutoRenew': 'true', 'NameServers': ["ns1.example.com"]},
+        {'AutoRenew': 'true', 'NameServers': ["ns1.example.com"]}
+    )
+
+    index.create_or_update(event, None)
+    assert sorted(index.domain_manager.events) == [
+        "enable_domain_auto_renew", "update_domain_contact", "update_domain_nameservers"
+    ]
+
+
+def test_fleet_update_skips_unchanged_domains(monkeypatch):
+    monkeypatch.setattr(index.helper, 'Data', {})
+    index.domain_manager = DomainManagerFleetFake()
+
+    event = _fleet_event(["foo.com", "new.com"], old_domain_names = ["foo.com"])
+    index.create_or_update(event, None)
+    assert index.domain_manager.registered == ["new.com"]
+    assert index.helper.Data == {'Succeeded': 2, 'Failed': 0}
+
+    index.domain_manager = DomainManagerFleetFake()
+    index.create_or_update(_fleet_event(["foo.com"], old_domain_names = ["foo.com"]), None)
+    assert index.domain_manager.list_domains_calls == 0
+
+
+def test_fleet_update_forgets_removed_domains(tmp_path, monkeypatch):
+    monkeypatch.setattr(index.helper, 'Data', {})
+    monkeypatch.setattr(index, 'desired_state_store', index.JsonFileDesiredStateStore(str(tmp_path / "desired.json")))
+    index.domain_manager = DomainManagerFleetFake()
+
+    index.create_or_update(_fleet_event(["foo.com", "new.com"], old_domain_names = ["foo.com"]), None)
+    index.create_or_update(_fleet_event(["new.com"], old_domain_names = ["foo.com", "new.com"]), None)
+
+    assert [state.domain_name for state in index.desired_state_store.all()] == ["new.com"]
+
+
+@pytest.mark.parametrize('file_name', ["desired.json", "desired.db"])
+def test_desired_state_store_round_trip(tmp_path, file_name):
+    store = index.open_desired_state_store(str(tmp_path / file_name))
+    first = index.parse_properties({'DomainName': "a.com", 'Contact': _contact(), 'TransferAuthCode': "secret"})
+    second = index.parse_properties({'DomainName': "b.com", 'Contact': _contact(), 'NameServers': ["ns1.example.com"]})
+
+    store.put([first, second])
+    store.remove(["a.com"])
+    store.put([first])
+
+    states = sorted(store.all(), key = lambda domain_event: domain_event.domain_name)
+    assert [state.domain_name for state in states] == ["a.com", "b.com"]
+    assert states[0].transfer_auth_code is None
+    assert states[0].contact == first.contact
+    assert states[1].name_servers == [index.NameServer("ns1.example.com")]
+
+
+def test_drift_handler_reports_and_repairs(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, 'desired_state_store', index.JsonFileDesiredStateStore(str(tmp_path / "desired.json")))
+
+    # Create records the desired state of foo.com; gone.com was recorded
+    # earlier but has since left the account.
+    index.domain_manager = DomainManagerFake()
+    index.create_or_update(_drifted_event(), None)
+    index.record_desired_state([index.parse_properties({'DomainName': "gone.com", 'Contact': _contact()})])
+
+    index.domain_manager = DomainManagerDriftedFake()
+    report = index.drift_handler({}, None)
+    assert report['Checked'] == 1
+    assert report['Drifted'] == {
+        "foo.com": ["update_domain_contact", "enable_domain_auto_renew", "update_domain_nameservers"]
+    }
+    assert report['Missing'] == ["gone.com"]
+    assert report['Repaired'] == []
+    assert index.domain_manager.events == []
+
+    report = index.drift_handler({'Repair': True}, None)
+    assert report['Repaired'] == ["foo.com"]
+    assert sorted(index.domain_manager.events) == [
+        "enable_domain_auto_renew", "update_domain_contact", "update_domain_nameservers"
+    ]
+
+
+def test_drift_handler_checks_other_accounts_through_their_role(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, 'desired_state_store', index.JsonFileDesiredStateStore(str(tmp_path / "desired.json")))
+    role = "arn:aws:iam::111111111111:role/DomainResourceRole"
+    other_account = DomainManagerDriftedFake()
+    index.domain_manager = DomainManagerRegisterFake()
+    monkeypatch.setattr(index, 'domain_managers', index.DomainManagerPool(index.domain_manager, lambda role_arn: other_account))
+
+    event = _drifted_event()
+    event['ResourceProperties']['AccountId'] = "111111111111"
+    index.domain_manager = other_account
+    index.create_or_update(event, None)
+    assert [state.role_arn for state in index.desired_state_store.all()] == [role]
+
+    index.domain_manager = index.domain_managers.default
+    report = index.drift_handler({}, None)
+    assert report['Missing'] == []
+    assert report['Checked'] == 1
+    assert list(report['Drifted']) == ["foo.com"]
+
+
+class DomainManagerOutOfTimeDetailFake(DomainManagerFake):
+    """A fake that refuses every get_domain_detail, as DomainManagerLive
+    does once too little time is left before the deadline."""
+
+    def get_domain_detail(self, domain_name):
+        raise index.DeadlineExceeded("No time left to call get_domain_detail")
+
+
+def test_drift_handler_skips_domains_it_has_no_time_for(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, 'desired_state_store', index.JsonFileDesiredStateStore(str(tmp_path / "desired.json")))
+    index.record_desired_state([index.parse_properties({'DomainName': "foo.com", 'Contact': _contact()})])
+    index.domain_manager = DomainManagerOutOfTimeDetailFake()
+
+    report = index.drift_handler({}, None)
+    assert report['Skipped'] == ["foo.com"]
+    assert report['Failed'] == {}
+    assert report['Checked'] == 0
+
+
+def test_delete_stops_drift_checks(tmp_path, monkeypatch):
+    monkeypatch.setattr(index, 'desired_state_store', index.JsonFileDesiredStateStore(str(tmp_path / "desired.json")))
+    index.record_desired_state([index.parse_properties({'DomainName': "foo.com", 'Contact': _contact()})])
+
+    index.domain_manager = DomainManagerFake()
+    index.delete({'RequestType': 'Delete', 'ResourceProperties': {'DomainName': "foo.com"}}, None)
+    assert index.desired_state_store.all() == []
+    assert index.domain_manager.events == []
+
+
+class DomainManagerPriceFake(DomainManagerRegisterFake):
+    """A register fake counting price listings and availability checks,
+    whose .nt TLD can't be transferred in."""
+
+    def list_prices(self, **kwargs):
+        self.events.append("list_prices")
+        response = super().list_prices(**kwargs)
+        if kwargs['Tld'] == 'nt':
+            del response['Prices'][0]['TransferPrice']
+        return response
+
+    def check_domain_availability(self, *args, **kwargs):
+        self.events.append("check_domain_availability")
+        return super().check_domain_availability(*args, **kwargs)
+
+
+def _register_event(domain_name, **properties):
+    return {
+        'RequestType': 'Create',
+        'ResourceProperties': dict({'DomainName': domain_name, 'Contact': _contact()}, **properties)
+    }
+
+
+def test_register_defaults_to_tld_minimum_duration(monkeypatch):
+    monkeypatch.setattr(index, 'tld_cache', index.TldMetadataCache(ttl = 60))
+    index.domain_manager = DomainManagerPriceFake()
+
+    index.create_or_update(_register_event("newdomain.ai"), None)
+    assert index.domain_manager.register_kwargs['DurationInYears'] == 2
+
+
+def test_invalid_duration_fails_before_registrar_checks(monkeypatch):
+    monkeypatch.setattr(index, 'tld_cache', index.TldMetadataCache(ttl = 60))
+    index.domain_manager = DomainManagerPriceFake()
+
+    with pytest.raises(ValueError, match = "DurationInYears 1 is not allowed for .ai domains"):
+        index.create_or_update(_register_event("newdomain.ai", DurationInYears = 1), None)
+    assert index.domain_manager.events == ["list_prices"]
+
+    with pytest.raises(ValueError, match = ".nt domains don't support transfers"):
+        index.create_or_update(_register_event("newdomain.nt", TransferAuthCode = "abc123"), None)
+    assert "check_domain_availability" not in index.domain_manager.events
+
+
+def test_tld_cache_hits_need_no_network(tmp_path):
+    now = [0.0]
+    path = str(tmp_path / "tlds.json")
+    cache = index.TldMetadataCache(ttl = 100, path = path, clock = lambda: now[0])
+    fetched = []
+
+    def fetch(tld):
+        fetched.append(tld)
+        return {'Name': tld, 'RegistrationPrice': {'Price': 80.0, 'Currency': 'USD'}}
+
+    rules = cache.rules("ai", fetch)
+    assert (rules.min_years, rules.registration_price, rules.transferable) == (2, 80.0, False)
+    cache.rules("ai", fetch)
+
+    # A new container picks the listing up from the file.
+    index.TldMetadataCache(ttl = 100, path = path, clock = lambda: now[0]).rules("ai", fetch)
+    assert fetched == ["ai"]
+
+    now[0] = 101
+    cache.rules("ai", fetch)
+    assert fetched == ["ai", "ai"]
+
+
+def test_tld_price_failure_falls_back_to_static_rules():
+    cache = index.TldMetadataCache(ttl = 100)
+
+    def fetch(tld):
+        raise Exception("AccessDenied")
+
+    assert cache.rules("ai", fetch).min_years == 2
+    assert cache.rules("com", fetch).transferable
+
+
+def test_invalid_properties_fail_before_any_registrar_call():
+    index.domain_manager = DomainManagerPriceFake()
+    contact = dict(_contact(), phoneNumber = "555-1212", countryCode = "XX")
+    del contact['email']
+
+    with pytest.raises(ValueError) as e:
+        index.create_or_update({
+            'RequestType': 'Create',
+            'ResourceProperties': {
+                'DomainName': "newdomain.com",
+                'Contact': contact,
+                'NameServers': ["ns1.example.com.", {'Name': "-ns2.example.com", 'GlueIps': ["192.0.2.300"]}],
+                'AutoRenew': "yes"
+            }
+        }, None)
+
+    message = str(e.value)
+    for error in ["Contact.email is required", "Contact.phoneNumber '555-1212'", "Contact.countryCode 'XX'",
+                  "NameServers[1].Name '-ns2.example.com'", "NameServers[1].GlueIps[0] '192.0.2.300'", "AutoRenew 'yes'"]:
+        assert error in message
+    assert "NameServers[0]" not in message
+    assert index.domain_manager.events == []
+
+
+def test_invalid_fleet_entries_fail_before_any_registrar_call():
+    index.domain_manager = DomainManagerPriceFake()
+
+    with pytest.raises(ValueError, match = r"Domains\[1\]\.Contact is required; Domains\[2\]\.DomainName 'a.com' is listed more than once"):
+        index.create_or_update({
+            'RequestType': 'Create',
+            'ResourceProperties': {'Domains': [
+                {'DomainName': "a.com", 'Contact': _contact()},
+                {'DomainName': "b.com"},
+                {'DomainName': "a.com", 'Contact': _contact()}
+            ]}
+        }, None)
+    assert index.domain_manager.events == []
+
+
+def test_auto_renew_string_false_disables_auto_renew():
+    assert index.parse_properties({'DomainName': "foo.com", 'Contact': _contact(), 'AutoRenew': "false"}).auto_renew is False
+
+
+def test_loadgen_stack_deploy_without_contention():
+    results = {result.phase: result for result in loadgen.run(
+        resources = 6, containers = 2, registrar_tps = 1000, registrar_burst = 1000, latency = 0
+    )}
+
+    for result in results.values():
+        assert (result.succeeded, result.failed, result.missing) == (6, 0, 0)
+        assert result.duplicate_mutations == result.duplicate_responses == result.throttled == 0
+    assert results['Create'].cold_starts == 2
+    assert results['Delete'].registrar_calls == 0
+
+
+def test_nameservers_compare_canonically():
+    parsed = index.parse_properties({'DomainName': "foo.com", 'Contact': _contact(), 'NameServers': [
+        "NS2.Example.com.",
+        {'Name': "ns1.foo.com", 'GlueIps': ["2001:0db8::0001", "192.0.2.1"]}
+    ]}).name_servers
+    registrar = [
+        index.NameServer.from_boto({'Name': "ns1.foo.com", 'GlueIps': ["192.0.2.1", "2001:db8::1"]}),
+        index.NameServer.from_boto({'Name': "ns2.example.com"})
+    ]
+
+    assert index.nameservers_are_equal(parsed, registrar)
+    # Nameservers given without glue match whatever glue the registrar has.
+    assert index.nameservers_are_equal([index.NameServer("ns1.foo.com"), index.NameServer("ns2.example.com")], registrar)
+    assert not index.nameservers_are_equal([index.NameServer("ns1.foo.com", ("192.0.2.2",)), index.NameServer("ns2.example.com")], registrar)
+    assert parsed[1].to_boto() == {'Name': "ns1.foo.com", 'GlueIps': ["192.0.2.1", "2001:db8::1"]}
+
+
+def test_nameserver_update_keeps_registrar_glue():
+    domain_manager = DomainManagerFake()
+    detail = domain_manager.get_domain_detail("foo.com")
+    detail['Nameservers'] = [{'Name': "ns1.foo.com", 'GlueIps': ["192.0.2.1"]}, {'Name': "ns2.example.com"}]
+    domain_event = index.parse_properties({'DomainName': "foo.com", 'Contact': _contact(), 'NameServers': [
+        "ns1.foo.com.", "NS2.EXAMPLE.COM"
+    ]})
+
+    assert index.plan_domain_changes(domain_manager, domain_event, detail, {'name_servers'}) == []
+
+    domain_event.name_servers.append(index.NameServer("ns3.example.com"))
+    sent = []
+    domain_manager.update_domain_nameservers = lambda domain_name, name_servers: sent.append(name_servers)
+    [change] = index.plan_domain_changes(domain_manager, domain_event, detail, {'name_servers'})
+    change.apply()
+    assert [ns.to_boto() for ns in sent[0]] == [
+        {'Name': "ns1.foo.com", 'GlueIps': ["192.0.2.1"]}, {'Name': "ns2.example.com"}, {'Name': "ns3.example.com"}
+    ]
+
+
+def test_domain_attributes_come_from_the_detail_already_fetched(monkeypatch):
+    monkeypatch.setattr(index.helper, 'Data', {})
+    domain_manager = bench_all.DomainManagerBenchFake(domains = 1, operations = 0)
+    index.domain_manager = domain_manager
+
+    index.create_or_update({
+        'RequestType': 'Update',
+        'ResourceProperties': {'DomainName': "domain00000.com", 'Contact': _contact(),
+                               'AutoRenew': 'false', 'NameServers': ["NS2.example.com."]},
+        'OldResourceProperties': {'DomainName': "domain00000.com", 'Contact': _contact(),
+                                  'AutoRenew': 'true', 'NameServers': ["ns1.example.com"]}
+    }, None)
+
+    assert domain_manager.calls == {
+        'get_domain_detail': 1, 'disable_domain_auto_renew': 1, 'update_domain_nameservers': 1
+    }
+    assert index.helper.Data == {
+        'DomainName': "domain00000.com",
+        'CreationDate': "",
+        'ExpirationDate': "",
+        'Status': "",
+        'AutoRenew': "false",
+        'TransferLock': "false",
+        'NameServers': "ns2.example.com",
+        'RegistrarName': "",
+        'RegistrarUrl': ""
+    }
+
+
+def test_domain_attributes_format_registrar_detail():
+    expiry = datetime(2030, 1, 2, tzinfo = timezone.utc)
+    attributes = index.domain_attributes({
+        'DomainName': "foo.com",
+        'ExpirationDate': expiry,
+        'StatusList': ["clientTransferProhibited", "clientDeleteProhibited"],
+        'AutoRenew': True,
+        'Nameservers': [{'Name': "ns1.foo.com", 'GlueIps': ["192.0.2.1"]}, {'Name': "ns2.example.com"}],
+        'RegistrarName': "Amazon Registrar, Inc."
+    })
+
+    assert attributes['ExpirationDate'] == "2030-01-02T00:00:00+00:00"
+    assert attributes['Status'] == "clientTransferProhibited,clientDeleteProhibited"
+    assert (attributes['AutoRenew'], attributes['TransferLock']) == ("true", "true")
+    assert attributes['NameServers'] == "ns1.foo.com,ns2.example.com"
+    assert attributes['RegistrarName'] == "Amazon Registrar, Inc."
+
+
+def test_pool_keeps_one_manager_per_role():
+    default = DomainManagerFake()
+    pool = index.DomainManagerPool(default, index.role_domain_manager)
+    role = "arn:aws:iam::111111111111:role/DomainResourceRole"
+
+    assert pool.get(None) is default
+    manager = pool.get(role)
+    assert pool.get(role) is manager
+    assert manager.role_arn == role
+    other = pool.get("arn:aws:iam::222222222222:role/DomainResourceRole")
+    assert other.cache is not manager.cache and other.cache is not index.registrar_cache
+    assert other.rate_limiter is not manager.rate_limiter
+
+    assert index.target_role_arn({'AccountId': "111111111111"}) == role
+    with pytest.raises(ValueError, match = "AccountId '1111' must be a 12-digit AWS account ID"):
+        index.validate_event_properties({'DomainName': "foo.com", 'Contact': _contact(), 'AccountId': "1111"})
+
+
+def test_live_role_client_assumes_role_lazily(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', "default")
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', "default")
+    domain_manager = DomainManagerLive(role_arn = "arn:aws:iam::111111111111:role/DomainResourceRole")
+    assumed = []
+
+    def assume_role():
+        assumed.append(domain_manager.role_arn)
+        return {
+            'access_key': "assumed", 'secret_key': "secret", 'token': "token",
+            'expiry_time': (datetime.now(timezone.utc) + timedelta(hours = 1)).isoformat()
+        }
+
+    monkeypatch.setattr(domain_manager, '_assume_role', assume_role)
+    client = domain_manager.client
+    assert assumed == []
+
+    credentials = client._request_signer._credentials.get_frozen_credentials()
+    assert credentials.access_key == "assumed"
+    client._request_signer._credentials.get_frozen_credentials()
+    assert len(assumed) == 1
+
+
+class _LambdaContext:
+    def __init__(self, seconds):
+        self.deadline = time.monotonic() + seconds
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def _delete_event(sink_url, **extra):
+    return dict({
+        'RequestType': 'Delete',
+        'ResponseURL': f"{sink_url}/responses/delete-1",
+        'StackId': "arn:aws:cloudformation:us-east-1:123456789012:stack/test/1",
+        'RequestId': "delete-1",
+        'LogicalResourceId': "Domain",
+        'PhysicalResourceId': "foo.com",
+        'ResourceProperties': {'DomainName': "foo.com", 'Contact': _contact()}
+    }, **extra)
+
+
+def test_fast_delete_responds_without_sleeping(monkeypatch):
+    monkeypatch.setattr(index, 'FAST_DELETE', True)
+    sink = loadgen.ResponseSink()
+    server = loadgen._serve(sink.handler())
+    try:
+        started = time.perf_counter()
+        index.handler(_delete_event(loadgen._url(server)), _LambdaContext(300))
+        assert time.perf_counter() - started < 1
+    finally:
+        server.shutdown()
+
+    [response] = sink.responses["delete-1"]
+    assert (response['Status'], response['PhysicalResourceId'], response['LogicalResourceId']) == ('SUCCESS', "foo.com", "Domain")
+
+
+def test_fast_delete_watchdog_fails_a_hung_delete(monkeypatch):
+    monkeypatch.setattr(index, 'FAST_DELETE', True)
+    monkeypatch.setattr(index, 'delete', lambda event, context: time.sleep(1.5))
+    sink = loadgen.ResponseSink()
+    server = loadgen._serve(sink.handler())
+    try:
+        index.handler(_delete_event(loadgen._url(server)), _LambdaContext(1.2))
+    finally:
+        server.shutdown()
+
+    [response] = sink.responses["delete-1"]
+    assert (response['Status'], response['Reason']) == ('FAILED', "Execution timed out")
+
+
+def test_soonest_expiring_stops_reading_sorted_inventory():
+    now = datetime(2030, 1, 1, tzinfo = timezone.utc)
+    read = []
+
+    def summaries(days):
+        for i, day in enumerate(days):
+            read.append(i)
+            yield {'DomainName': f"d{i}.com", 'Expiry': now + timedelta(days = day)}
+
+    expiring = index.soonest_expiring(summaries(range(1, 1000)), now + timedelta(days = 30), limit = 5, ordered = True)
+    assert [summary['DomainName'] for summary in expiring] == ["d0.com", "d1.com", "d2.com", "d3.com", "d4.com"]
+    assert len(read) == 6
+
+    read.clear()
+    expiring = index.soonest_expiring(summaries([40, 9, 3, 50, 7, 1, 20]), now + timedelta(days = 10), limit = 3)
+    assert [summary['DomainName'] for summary in expiring] == ["d5.com", "d2.com", "d4.com"]
+    assert len(read) == 7
+
+
+class DomainManagerLapsingFake(bench_all.DomainManagerBenchFake):
+    def get_domain_detail(self, domain_name):
+        detail = super().get_domain_detail(domain_name)
+        if domain_name == "domain00001.com":
+            detail['AutoRenew'] = False
+        return detail
+
+
+def test_renewal_watch_checks_only_soonest_expiring():
+    index.domain_manager = DomainManagerLapsingFake(domains = 100, operations = 0)
+
+    lines = []
+    report = index.renewal_watch_handler({'WindowDays': 5.5, 'MaxDomains': 3}, None, emit = lines.append)
+
+    assert index.domain_manager.calls == {'list_domains': 1, 'get_domain_detail': 3}
+    assert [entry['DomainName'] for entry in report['Expiring']] == ["domain00000.com", "domain00001.com", "domain00002.com"]
+    [at_risk] = report['AtRisk']
+    assert (at_risk['DomainName'], at_risk['Risks']) == ("domain00001.com", ['AutoRenew disabled'])
+
+    [emf] = [json.loads(line) for line in lines]
+    assert (emf['ExpiringDomains'], emf['AtRiskDomains']) == (3, 1)
+    [directive] = emf['_aws']['CloudWatchMetrics']
+    assert directive['Namespace'] == 'DomainResource'
+    assert {metric['Name']: metric['Unit'] for metric in directive['Metrics']} == {
+        'ExpiringDomains': 'Count', 'AtRiskDomains': 'Count', 'MinDaysToExpiry': 'None'
+    }
+
+
+class DomainManagerLapsingOutOfTimeFake(DomainManagerLapsingFake):
+    """A lapsing fake that refuses every get_domain_detail after the first,
+    as DomainManagerLive does once too little time is left."""
+
+    def get_domain_detail(self, domain_name):
+        if self.calls['get_domain_detail']:
+            raise index.DeadlineExceeded("No time left to call get_domain_detail")
+        return super().get_domain_detail(domain_name)
+
+
+def test_renewal_watch_skips_domains_it_has_no_time_for():
+    index.domain_manager = DomainManagerLapsingOutOfTimeFake(domains = 100, operations = 0)
+
+    lines = []
+    report = index.renewal_watch_handler({'WindowDays': 5.5, 'MaxDomains': 3}, None, emit = lines.append)
+
+    assert [entry['DomainName'] for entry in report['Expiring']] == ["domain00000.com"]
+    assert report['Skipped'] == ["domain00001.com", "domain00002.com"]
+    [emf] = [json.loads(line) for line in lines]
+    assert emf['ExpiringDomains'] == 1